@@ -20,6 +20,7 @@ import hashlib
 import base64
 import websocket
 import re
+import collections
 import paho.mqtt.client as mqtt
 from datetime import datetime
 from datetime import timedelta
@@ -35,12 +36,21 @@ memory_held_last_events = {
     'dnd_state': "",
 }
 
+# events delivered with one call of BATCH_METHOD; 1: every event with its own call
+BATCH_SIZE = int(os.getenv('ASTERISK_CONNECTOR_BATCH_SIZE') or 1)
+BATCH_METHOD = os.getenv('ASTERISK_CONNECTOR_BATCH_METHOD') or 'asterisk_batch'
+
 odoo_data = {}
 odoo_data['uid'] = None
+odoo_data['batch'] = BATCH_SIZE > 1
+odoo_proxies = {}
 EXPIRE_CHANNEL = 3600 * 24 # seconds
 redis_connection_pool = redis.BlockingConnectionPool(host=os.environ['REDIS_HOST'])
 
-CONST_PERM_DIR = os.environ['PERM_DIR']
+# events for odoo are queued in this redis list
+ODOO_QUEUE = 'odoo_events'
+# events of older versions are spooled here; taken over at start
+CONST_PERM_DIR = os.getenv('PERM_DIR')
 dir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))) # script directory
 
 mqttclient = None
@@ -93,10 +103,16 @@ class throttle(object):
 
         return wrapper
 
+def get_proxy(service):
+    # the transport of a proxy keeps its http connection alive between calls
+    if service not in odoo_proxies:
+        odoo_proxies[service] = xmlrpclib.ServerProxy('%s/xmlrpc/%s' % (odoo['host'], service))
+    return odoo_proxies[service]
+
 def exe(*params):
     started = datetime.now()
 
-    socket_obj = xmlrpclib.ServerProxy('%s/xmlrpc/object' % (odoo['host']))
+    socket_obj = get_proxy('object')
     try:
         result = socket_obj.execute(odoo['db'], odoo_data['uid'], odoo['pwd'], *params)
     except Exception as e:
@@ -110,6 +126,102 @@ def exe(*params):
     logger.info("ODOO call took {}".format((datetime.now() - started).total_seconds()))
     return result
 
+def exe_batch(events):
+    """
+    Delivers the events with one call; returns False, if they have to be
+    delivered one by one.
+    """
+    events = [json.loads(x) for x in events]
+    if len(events) < 2 or not odoo_data['batch'] or any(x[0] != 'asterisk.connector' for x in events):
+        return False
+    try:
+        exe('asterisk.connector', BATCH_METHOD, [x[1:] for x in events])
+    except Exception as e:
+        if "has no attribute '{}'".format(BATCH_METHOD) in str(e):
+            odoo_data['batch'] = False
+            logger.warning("Odoo does not provide asterisk.connector.{} - delivering events one by one".format(BATCH_METHOD))
+        else:
+            logger.warning("Batch of {} events failed - delivering them one by one".format(len(events)))
+        return False
+    return True
+
+class OdooQueue(object):
+    """
+    Events for odoo in the order they happened. Every event is appended to
+    a redis list first, so that it survives a restart; the odoo thread takes
+    the events from memory and removes them from redis after delivery.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.condition = threading.Condition()
+        self.events = collections.deque()
+        self.loaded = False
+
+    def _redis(self):
+        return redis.StrictRedis(connection_pool=redis_connection_pool)
+
+    def _take_over_files(self):
+        if not CONST_PERM_DIR or not os.path.isdir(CONST_PERM_DIR):
+            return
+        files = sorted(x for x in os.listdir(CONST_PERM_DIR) if x.startswith("odoo_") and x.endswith('.params'))
+        # they are older than the events in redis
+        for filename in reversed(files):
+            filepath = os.path.join(CONST_PERM_DIR, filename)
+            with open(filepath, 'r') as f:
+                self._redis().lpush(self.key, f.read())
+            os.unlink(filepath)
+        if files:
+            logger.info("Took over {} events from {}".format(len(files), CONST_PERM_DIR))
+
+    def load(self):
+        """
+        Loads the events, that were not delivered before the restart.
+        """
+        with self.condition:
+            self._take_over_files()
+            self.events.extend(self._redis().lrange(self.key, 0, -1))
+            self.loaded = True
+            if self.events:
+                logger.info("{} events waiting for odoo".format(len(self.events)))
+                self.condition.notify()
+
+    def put(self, *params):
+        params = json.dumps(params)
+        with self.condition:
+            self._redis().rpush(self.key, params)
+            if self.loaded:
+                self.events.append(params)
+                self.condition.notify()
+
+    def peek(self, count=1):
+        """
+        Returns the next events without removing them; waits for the first one.
+        """
+        with self.condition:
+            while not self.events:
+                self.condition.wait()
+            return [self.events[i] for i in range(min(count, len(self.events)))]
+
+    def ack(self, events):
+        """
+        Removes the delivered events.
+        """
+        with self.condition:
+            pipeline = self._redis().pipeline()
+            for params in events:
+                pipeline.lrem(self.key, 1, params)
+            pipeline.execute()
+            for params in events:
+                self.events.popleft()
+
+    def __len__(self):
+        return len(self.events)
+
+
+odoo_queue = OdooQueue(ODOO_QUEUE)
+
+
 class Connector(object):
 
     def __init__(self):
@@ -183,12 +295,7 @@ class Connector(object):
         return result
 
     def _odoo(self, *params):
-        params = json.dumps(params)
-
-        filename = 'odoo_' + datetime.now().strftime("%Y-%m-%d %H:%M:%S:%f") + '.params'
-        with open(os.path.join(CONST_PERM_DIR, filename), 'w') as f:
-            f.write(params)
-            f.flush()
+        odoo_queue.put(*params)
 
     def _on_attended_transfer(self, channel_ids):
         self._odoo('asterisk.connector', 'asterisk_on_attended_transfer', channel_ids)
@@ -373,7 +480,8 @@ class Connector(object):
     @cp.expose
     def get_memory_held_last_events(self):
         return {
-            'str': str(memory_held_last_events)
+            'str': str(memory_held_last_events),
+            'odoo_queue': len(odoo_queue),
         }
 
     @cp.expose
@@ -503,7 +611,7 @@ def odoo_thread():
     while not odoo_data['uid']:
         try:
             def login(username, password):
-                socket_obj = xmlrpclib.ServerProxy('%s/xmlrpc/common' % (odoo['host']))
+                socket_obj = get_proxy('common')
                 uid = socket_obj.login(odoo['db'], username, password)
                 return uid
             odoo_data['uid'] = login(odoo['username'], odoo['pwd'])
@@ -515,36 +623,33 @@ def odoo_thread():
 
     while True:
         try:
-            files = os.listdir(CONST_PERM_DIR)
-            files = sorted(files)
-            for filename in files:
-                if not filename.startswith("odoo_") or not filename.endswith('.params'):
-                    continue
-                filepath = os.path.join(CONST_PERM_DIR, filename)
-                with open(filepath, 'r') as f:
-                    params = json.loads(f.read())
-                had_error = False
-                while True:
-                    try:
-                        exe(*params)
-                        if had_error:
-                            had_error = False
-                            logger.info("Odoo is back online and just accepted packages")
-                    except Exception:
-                        had_error = True
-                        msg = traceback.format_exc()
-                        logger.error(msg)
-                        time.sleep(1)
-                        break
-                    else:
-                        os.unlink(filepath)
-                        break
+            odoo_queue.load()
+        except Exception:
+            msg = traceback.format_exc()
+            logger.error(msg)
+            time.sleep(2)
+        else:
+            break
 
+    had_error = False
+    while True:
+        try:
+            # the first event is retried until odoo accepts it, so the order is kept
+            events = odoo_queue.peek(BATCH_SIZE)
+            if exe_batch(events):
+                odoo_queue.ack(events)
+            else:
+                for params in events:
+                    exe(*json.loads(params))
+                    odoo_queue.ack([params])
+            if had_error:
+                had_error = False
+                logger.info("Odoo is back online and just accepted packages")
         except Exception:
+            had_error = True
             msg = traceback.format_exc()
             logger.error(msg or '')
             time.sleep(1)
-        time.sleep(0.1)
 
 def on_mqtt_connect(client, userdata, flags, rc):
     memory_held_last_events['mqtt_connected'] = True
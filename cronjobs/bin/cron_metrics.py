@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+# Metrics of the cronjobs daemon in the prometheus text format, served over
+# http from a daemon thread.
+import time
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+METRICS = [
+    # name, type, help, key in the job data
+    ("cron_job_next_run_timestamp_seconds", "gauge", "Next planned run", "next"),
+    ("cron_job_running", "gauge", "Currently running executions", "running"),
+    ("cron_job_runs_total", "counter", "Finished executions", "runs"),
+    ("cron_job_failures_total", "counter", "Executions with exit code != 0", "failures"),
+    ("cron_job_skipped_total", "counter", "Runs skipped by the overlap policy", "skipped"),
+    ("cron_job_last_duration_seconds", "gauge", "Duration of the last execution", "duration"),
+    ("cron_job_last_rc", "gauge", "Exit code of the last execution", "rc"),
+    ("cron_job_last_success_timestamp_seconds", "gauge", "End of the last successful execution", "success"),
+    ("cron_job_lag_seconds", "gauge", "Actual minus planned fire time of the last run", "lag"),
+    ("cron_job_wait_seconds", "gauge", "Time the last run waited for its locks and slot", "wait"),
+]
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class CronMetrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.start_time = time.time()
+
+    def _job(self, name):
+        return self.jobs.setdefault(name, {
+            "next": None,
+            "running": 0,
+            "runs": 0,
+            "failures": 0,
+            "skipped": 0,
+            "duration": None,
+            "rc": None,
+            "success": None,
+            "lag": None,
+            "wait": None,
+        })
+
+    def scheduled(self, name, next_run):
+        with self.lock:
+            self._job(name)["next"] = next_run.timestamp()
+
+    def dispatched(self, name, planned, fired):
+        with self.lock:
+            self._job(name)["lag"] = (fired - planned).total_seconds()
+
+    def skipped(self, name):
+        with self.lock:
+            self._job(name)["skipped"] += 1
+
+    def started(self, name, waited):
+        with self.lock:
+            data = self._job(name)
+            data["running"] += 1
+            data["wait"] = waited
+
+    def finished(self, name, rc, duration):
+        with self.lock:
+            data = self._job(name)
+            data["running"] -= 1
+            data["runs"] += 1
+            data["duration"] = duration
+            data["rc"] = rc
+            if rc:
+                data["failures"] += 1
+            else:
+                data["success"] = time.time()
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, kind, description, key in METRICS:
+                lines.append(f"# HELP {name} {description}")
+                lines.append(f"# TYPE {name} {kind}")
+                for job, data in sorted(self.jobs.items()):
+                    if data[key] is not None:
+                        lines.append(f'{name}{{job="{_escape(job)}"}} {data[key]}')
+            running = sum(x["running"] for x in self.jobs.values())
+        lines += [
+            "# HELP cron_jobs_running Currently running executions of all jobs",
+            "# TYPE cron_jobs_running gauge",
+            f"cron_jobs_running {running}",
+            "# HELP cron_daemon_start_timestamp_seconds Start of the daemon",
+            "# TYPE cron_daemon_start_timestamp_seconds gauge",
+            f"cron_daemon_start_timestamp_seconds {self.start_time}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="0.0.0.0"):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ["/", "/metrics"]:
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
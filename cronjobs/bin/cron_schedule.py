@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+# Parses the value of a CRONJOB_* setting into schedule and command:
+#
+#   [TZ=<zone>] [JITTER=<seconds>] <5 or 6 fields or @macro> <command>
+#
+# A 6th field (seconds, as croniter counts them) is only taken, if the
+# token consists of digits and * / , - only.
+import re
+import random
+from datetime import datetime
+from datetime import timedelta
+from croniter import croniter
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # python < 3.9
+    ZoneInfo = None
+
+MACROS = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+OPTIONS = ["TZ", "JITTER"]
+RE_TOKEN = re.compile(r"\s*(\S+)")
+RE_SECONDS = re.compile(r"^[\d*/,\-]+$")
+
+
+class ScheduleError(Exception):
+    pass
+
+
+class Schedule(object):
+    def __init__(self, expression, tz=None, jitter=0):
+        self.expression = expression
+        self.tz = tz
+        self.jitter = jitter
+        self.zone = None
+        if tz:
+            if not ZoneInfo:
+                raise ScheduleError("Timezones require python 3.9")
+            try:
+                self.zone = ZoneInfo(tz)
+            except Exception:  # pylint: disable=broad-except
+                raise ScheduleError(f"Unknown timezone: {tz}")
+        try:
+            croniter(expression, datetime.now())
+        except Exception as ex:  # pylint: disable=broad-except
+            raise ScheduleError(f"Invalid schedule {expression}: {ex}")
+
+    def get_next(self, base):
+        """
+        Next fire time after base as naive local time like datetime.now().
+        """
+        if self.zone:
+            base = base.astimezone(self.zone)
+        result = croniter(self.expression, base).get_next(datetime)
+        if self.zone:
+            result = result.astimezone().replace(tzinfo=None)
+        if self.jitter:
+            result += timedelta(seconds=random.uniform(0, self.jitter))
+        return result
+
+    def __str__(self):
+        result = self.expression
+        if self.tz:
+            result += f" TZ={self.tz}"
+        if self.jitter:
+            result += f" JITTER={self.jitter:g}"
+        return result
+
+    __repr__ = __str__
+
+
+def _tokens(text):
+    pos = 0
+    while True:
+        match = RE_TOKEN.match(text, pos)
+        if not match:
+            return
+        pos = match.end()
+        yield match.group(1), pos
+
+
+def parse(text, tz=None):
+    """
+    Returns the schedule and the command; tz is the default timezone.
+    """
+    tokens = list(_tokens(text))
+    options = {}
+    index = 0
+    while index < len(tokens) and tokens[index][0].split("=", 1)[0] in OPTIONS:
+        key, _, value = tokens[index][0].partition("=")
+        options[key] = value
+        index += 1
+
+    if index < len(tokens) and tokens[index][0].startswith("@"):
+        macro = tokens[index][0].lower()
+        if macro not in MACROS:
+            raise ScheduleError(f"Unknown macro {macro}; allowed: {', '.join(MACROS)}")
+        expression = MACROS[macro]
+        index += 1
+    else:
+        fields = [x[0] for x in tokens[index:index + 6]]
+        if len(fields) < 6:
+            raise ScheduleError(f"Schedule and command required: {text}")
+        if not RE_SECONDS.match(fields[5]) or len(tokens) == index + 6:
+            fields = fields[:5]
+        expression = " ".join(fields)
+        index += len(fields)
+
+    if index >= len(tokens):
+        raise ScheduleError(f"Command missing: {text}")
+    command = text[tokens[index - 1][1]:].strip()
+
+    try:
+        jitter = float(options.get("JITTER") or 0)
+    except ValueError:
+        raise ScheduleError(f"Invalid jitter: {options['JITTER']}")
+    return Schedule(expression, tz=options.get("TZ") or tz, jitter=jitter), command
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+# Persistent history of the cronjob runs in a sqlite database in the run dir.
+import math
+import sqlite3
+import threading
+from datetime import datetime
+from datetime import timedelta
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job TEXT NOT NULL,
+    planned TIMESTAMP,
+    started TIMESTAMP NOT NULL,
+    finished TIMESTAMP,
+    rc INTEGER,
+    output_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_job_started ON runs (job, started);
+"""
+
+
+def percentile(values, percent):
+    """
+    Nearest rank percentile of the values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(math.ceil(percent / 100.0 * len(values)) - 1, 0)
+    return values[index]
+
+
+class JobLedger(object):
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        conn = self._connect()
+        try:
+            conn.executescript(SCHEMA)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(
+            str(self.path),
+            timeout=30,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+        )
+
+    def _execute(self, sql, params=()):
+        with self.lock:
+            conn = self._connect()
+            try:
+                with conn:
+                    cursor = conn.execute(sql, params)
+                    return cursor.lastrowid, cursor.fetchall()
+            finally:
+                conn.close()
+
+    def start(self, job, planned):
+        run_id, _ = self._execute(
+            "INSERT INTO runs (job, planned, started) VALUES (?, ?, ?)",
+            (job, planned, datetime.now()),
+        )
+        return run_id
+
+    def finish(self, run_id, rc, output_size):
+        self._execute(
+            "UPDATE runs SET finished = ?, rc = ?, output_size = ? WHERE id = ?",
+            (datetime.now(), rc, output_size, run_id),
+        )
+
+    def last_planned(self, job):
+        """
+        Fire time of the last scheduled run of the job.
+        """
+        _, rows = self._execute(
+            "SELECT max(planned) FROM runs WHERE job = ?", (job,)
+        )
+        value = rows[0][0] if rows else None
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+        return value
+
+    def runs(self, job=None, limit=None):
+        sql = "SELECT job, planned, started, finished, rc, output_size FROM runs"
+        params = []
+        if job:
+            sql += " WHERE job = ?"
+            params.append(job)
+        sql += " ORDER BY started DESC"
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        _, rows = self._execute(sql, params)
+        return rows
+
+    def stats(self, job=None):
+        """
+        Per job: count of runs, failures, unfinished runs, p50/p95/max of
+        the durations in seconds and the last run.
+        """
+        result = {}
+        for name, planned, started, finished, rc, output_size in reversed(self.runs(job)):
+            data = result.setdefault(name, {
+                "runs": 0,
+                "failed": 0,
+                "unfinished": 0,
+                "durations": [],
+                "last_started": None,
+                "last_rc": None,
+            })
+            data["runs"] += 1
+            data["last_started"] = started
+            data["last_rc"] = rc
+            if finished is None:
+                data["unfinished"] += 1
+                continue
+            if rc:
+                data["failed"] += 1
+            data["durations"].append((finished - started).total_seconds())
+        for data in result.values():
+            durations = data.pop("durations")
+            data["p50"] = percentile(durations, 50)
+            data["p95"] = percentile(durations, 95)
+            data["max"] = max(durations) if durations else None
+        return result
+
+    def prune(self, days):
+        self._execute(
+            "DELETE FROM runs WHERE started < ?",
+            (datetime.now() - timedelta(days=days),),
+        )
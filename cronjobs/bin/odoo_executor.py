@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+# Warm executor for "odoo ..." cronjobs: a server process imports the wodoo
+# command line once and forks a child per job, that runs the click entry
+# point with the stdout of the client (passed over the unix socket).
+#
+# The server runs with the interpreter of the odoo script (started by the
+# client part, that run.py uses).
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import socket
+import struct
+import logging
+import threading
+import subprocess
+import traceback
+from pathlib import Path
+
+logger = logging.getLogger("")  # root handler
+
+# commands containing these characters need a shell
+SHELL_CHARS = set(";|&<>`$(){}\n*?~")
+# after a failed start the shell is used that long
+RETRY_AFTER = 600
+
+
+def _send(sock, data):
+    payload = json.dumps(data).encode("utf-8")
+    sock.sendall(struct.pack("!I", len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+    buffer = b""
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("Odoo executor closed connection")
+        buffer += chunk
+    return buffer
+
+
+def _recv(sock):
+    (size,) = struct.unpack("!I", _recv_exactly(sock, 4))
+    return json.loads(_recv_exactly(sock, size).decode("utf-8"))
+
+
+def _load_cli():
+    from importlib.metadata import entry_points
+
+    try:
+        scripts = entry_points(group="console_scripts")
+    except TypeError:  # python < 3.10
+        scripts = entry_points().get("console_scripts", [])
+    scripts = [x for x in scripts if x.name == "odoo"]
+    if not scripts:
+        raise Exception("No console script 'odoo' installed")
+    # prefer wodoo over other packages providing odoo
+    scripts = sorted(scripts, key=lambda x: not x.value.startswith("wodoo"))
+    return scripts[0].load()
+
+
+def _run_child(conn, cli, output_fd, request):
+    os.dup2(output_fd, 1)
+    os.dup2(output_fd, 2)
+    os.close(output_fd)
+    rc = 0
+    try:
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = ["odoo"] + request["args"]
+        if hasattr(cli, "main"):
+            # click command
+            cli.main(args=request["args"], prog_name="odoo")
+        else:
+            rc = cli() or 0
+    except SystemExit as ex:
+        if isinstance(ex.code, int):
+            rc = ex.code
+        elif ex.code:
+            print(ex.code, file=sys.stderr)
+            rc = 1
+    except Exception:  # pylint: disable=broad-except
+        traceback.print_exc()
+        rc = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    _send(conn, {"rc": rc})
+
+
+def serve(socket_path):
+    cli = _load_cli()
+    socket_path = Path(socket_path)
+    if socket_path.exists():
+        socket_path.unlink()
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(socket_path))
+    server.listen(16)
+    server.settimeout(1)
+    while True:
+        # reap finished children
+        try:
+            while os.waitpid(-1, os.WNOHANG)[0]:
+                pass
+        except ChildProcessError:
+            pass
+        try:
+            conn, _ = server.accept()
+        except socket.timeout:
+            continue
+        conn.settimeout(None)
+        try:
+            # the output file descriptor comes with the length of the request
+            header, fds, _, _ = socket.recv_fds(conn, 4, 1)
+            if len(header) < 4:
+                header += _recv_exactly(conn, 4 - len(header))
+            (size,) = struct.unpack("!I", header)
+            request = json.loads(_recv_exactly(conn, size).decode("utf-8"))
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+            conn.close()
+            continue
+
+        if request["cmd"] == "ping":
+            _send(conn, {"pong": True})
+        elif request["cmd"] == "run" and fds:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if not pid:
+                server.close()
+                try:
+                    _run_child(conn, cli, fds[0], request)
+                finally:
+                    os._exit(0)
+        for fd in fds:
+            os.close(fd)
+        conn.close()
+
+
+def get_args(command):
+    """
+    Arguments of the odoo command or None, if it needs a shell.
+    """
+    if not command.startswith("odoo ") or SHELL_CHARS & set(command):
+        return None
+    try:
+        return shlex.split(command)[1:]
+    except ValueError:
+        return None
+
+
+class OdooExecutor(object):
+    """
+    Client side: starts the server and runs commands in it.
+    """
+
+    def __init__(self, socket_path, boot_timeout=60):
+        self.socket_path = Path(socket_path)
+        self.boot_timeout = boot_timeout
+        self.process = None
+        self.lock = threading.Lock()
+        self.failed = None
+
+    def _get_interpreter(self):
+        script = shutil.which("odoo")
+        if script:
+            with open(script, "rb") as f:
+                first_line = f.readline().decode("utf8", errors="ignore").strip()
+            if first_line.startswith("#!") and "python" in first_line:
+                return first_line[2:].split()
+        return [sys.executable]
+
+    def _connect(self, data, fds=()):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(str(self.socket_path))
+            payload = json.dumps(data).encode("utf-8")
+            socket.send_fds(sock, [struct.pack("!I", len(payload))], list(fds))
+            sock.sendall(payload)
+        except (ConnectionError, FileNotFoundError):
+            sock.close()
+            return None
+        return sock
+
+    def ping(self):
+        sock = self._connect({"cmd": "ping"})
+        if not sock:
+            return False
+        try:
+            sock.settimeout(5)
+            return bool(_recv(sock).get("pong"))
+        except (ConnectionError, socket.timeout):
+            return False
+        finally:
+            sock.close()
+
+    def start(self):
+        with self.lock:
+            if self.process and self.process.poll() is None and self.ping():
+                return True
+            if self.failed and time.time() - self.failed < RETRY_AFTER:
+                return False
+            if self.process:
+                self.process.kill()
+                self.process.wait()
+            logger.info("Starting odoo executor")
+            self.process = subprocess.Popen(
+                self._get_interpreter() + [__file__, str(self.socket_path)]
+            )
+            deadline = time.time() + self.boot_timeout
+            while time.time() < deadline and self.process.poll() is None:
+                if self.ping():
+                    self.failed = None
+                    return True
+                time.sleep(0.2)
+            logger.warning("Odoo executor not available - using shell")
+            self.failed = time.time()
+            return False
+
+    def run(self, args, cwd, env, handle_output):
+        """
+        Runs odoo with args; handle_output gets the output stream. Returns
+        the exit code or None if the executor is not available.
+        """
+        if not self.start():
+            return None
+        read_fd, write_fd = os.pipe()
+        try:
+            sock = self._connect(
+                {"cmd": "run", "args": args, "cwd": cwd, "env": dict(env)},
+                [write_fd],
+            )
+        finally:
+            os.close(write_fd)
+        if not sock:
+            os.close(read_fd)
+            return None
+        try:
+            with os.fdopen(read_fd, "rb") as output:
+                handle_output(output)
+            return _recv(sock)["rc"]
+        except ConnectionError:
+            return -1
+        finally:
+            sock.close()
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1])
@@ -1,6 +1,12 @@
 #!/usr/bin/python3
+import io
+import re
+import json
+import lzma
 import time
 import gzip
+import hashlib
+import tarfile
 import shutil
 import platform
 import psycopg2
@@ -15,12 +21,17 @@ from pathlib import Path
 from datetime import datetime
 import logging
 from contextlib import contextmanager
+from contextlib import ExitStack
 
 FORMAT = "[%(levelname)s] %(name) -12s %(asctime)s %(message)s"
 logging.basicConfig(format=FORMAT)
 logging.getLogger().setLevel(logging.DEBUG)
 logger = logging.getLogger("")  # root handler
 
+CODECS = ["gzip", "zstd", "lz4"]
+# assumed ratio of unzipped to zipped dump size for the free space check of --spool
+SPOOL_RATIO = 5
+
 
 class DBSizeOutputter(Thread):
     def __init__(self, host, dbname, port, user, password):
@@ -106,11 +117,24 @@ def execute(dbname, host, port, user, password, sql):
 @click.option(
     "--pigz",
     is_flag=True,
+    help="Same as --codec gzip",
+)
+@click.option(
+    "--codec",
+    type=click.Choice(CODECS),
+    help="Compress the dump stream instead of pg_dump (which then uses -Z0)",
 )
+@click.option("--level", type=int, help="Compression level of the codec")
+@click.option("--threads", type=int, default=0, help="Threads of the codec; default: -j")
 @click.option("-Z", "--compression", required=False, default=5)
 @click.option("--column-inserts", is_flag=True)
 @click.option("-T", "--exclude", multiple=True, help="Exclude Tables comma separated")
 @click.option("-j", "--worker", default=1)
+@click.option(
+    "--pack",
+    is_flag=True,
+    help="Directory dumptype: pack the dump directory into one tar file (with --codec compressed)",
+)
 def backup(
     dbname,
     host,
@@ -122,10 +146,17 @@ def backup(
     column_inserts,
     exclude,
     pigz,
+    codec,
+    level,
+    threads,
     compression,
     worker,
+    pack,
 ):
     port = int(port)
+    if pigz and not codec:
+        codec = "gzip"
+    threads = threads or worker
     filepath = Path(filepath)
     os.environ["PGPASSWORD"] = password
     conn = psycopg2.connect(
@@ -151,14 +182,24 @@ def backup(
 
         # FOR PERFORMANCE USE os.system
         err_dump = Path(tempfile.mkstemp()[1])
-        err_pigz = Path(tempfile.mkstemp()[1])
+        err_codec = Path(tempfile.mkstemp()[1])
         err_dump.unlink()
-        err_pigz.unlink()
+        err_codec.unlink()
 
         excludes = []
         for exclude in exclude:
             excludes += ["-T", exclude]
 
+        if dumptype == "directory":
+            sizes = _get_table_sizes(cr)
+            _backup_directory(
+                host, port, user, dbname, excludes, compression, worker,
+                temp_filepath, sizes, pack, codec, level, threads,
+            )
+            _remove_path(filepath)
+            temp_filepath.replace(filepath)
+            return
+
         cmd = (
             f"pg_dump {column_inserts} "
             f"--clean "
@@ -167,32 +208,212 @@ def backup(
             f"-p {port} "
             f'{" ".join(excludes)} '
             f'-U "{user}" '
-            f"-Z{compression} "
+            f"-Z{0 if codec else compression} "
             f"-F{dumptype[0].lower()} "
             f"-j {worker} "
             f" {dbname} "
             f"2>{err_dump} "
             f"| pv -s {bytes} "
         )
-        if pigz:
-            cmd += "| pigz --rsyncable 2>{err_pigz}"
+        if codec:
+            compress = _get_compress_cmd(codec, level, threads)
+            cmd += f"| {' '.join(pipes.quote(x) for x in compress)} 2>{err_codec} "
         cmd += f"> {temp_filepath} "
         try:
             os.system(cmd)
         finally:
-            for file in [err_dump, err_pigz]:
+            for file in [err_dump, err_codec]:
                 if file.exists() and file.read_text().strip():
                     raise Exception(file.read_text().strip())
 
         temp_filepath.replace(filepath)
     finally:
-        if temp_filepath and temp_filepath.exists():
-            temp_filepath.unlink()
+        if temp_filepath:
+            _remove_path(temp_filepath)
         conn.close()
         if stderr.exists():
             stderr.unlink()
 
 
+def _remove_path(path):
+    if path.is_dir() and not path.is_symlink():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+
+def _get_compress_cmd(codec, level=None, threads=1):
+    threads = max(threads or 1, 1)
+    if codec == "gzip":
+        pigz = next(_get_file("pigz"), None)
+        if pigz:
+            cmd = [pigz, "-p", str(threads), "--rsyncable"]
+        else:
+            click.secho("pigz not found - compressing single threaded", fg="yellow")
+            cmd = ["gzip", "--rsyncable"]
+    elif codec == "zstd":
+        cmd = ["zstd", "-q", f"-T{threads}", "--rsyncable"]
+        if level and level > 19:
+            cmd += ["--ultra"]
+    elif codec == "lz4":
+        # lz4 compresses single threaded, but is fast enough to keep up
+        cmd = ["lz4", "-q"]
+    else:
+        raise Exception(f"not impl: {codec}")
+    if level is not None:
+        cmd += [f"-{level}"]
+    return cmd
+
+
+def _get_decompress_cmd(codec, threads=1):
+    """
+    Command that decompresses stdin or the file appended to it to stdout.
+    """
+    threads = max(threads or 1, 1)
+    if codec == "gzip":
+        pigz = next(_get_file("pigz"), None)
+        if pigz:
+            return [pigz, "-dc", "-p", str(threads)]
+        click.secho("pigz not found - unzipping single threaded", fg="yellow")
+        return [next(_get_file("gunzip")), "-c"]
+    if codec == "zstd":
+        return ["zstd", "-dcq"]
+    if codec == "lz4":
+        return ["lz4", "-dcq"]
+    if codec == "xz":
+        return ["xz", "-dc", f"-T{threads}"]
+    raise Exception(f"not impl: {codec}")
+
+
+def _get_table_sizes(cr):
+    cr.execute(
+        "SELECT n.nspname, c.relname, pg_table_size(c.oid) "
+        "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relkind IN ('r', 'm', 'p') "
+        "AND n.nspname NOT IN ('pg_catalog', 'information_schema')"
+    )
+    return {f"{schema}.{table}": size for schema, table, size in cr.fetchall()}
+
+
+class DumpProgress(object):
+    """
+    Progress of pg_dump -v per table, weighted by the table sizes from
+    pg_class.
+    """
+
+    RE_STARTED = re.compile(r'dumping contents of table "?([^"\s]+)"?')
+    RE_FINISHED = re.compile(r"finished item \d+ TABLE DATA (\S+)")
+
+    def __init__(self, sizes, parallel):
+        self.sizes = sizes
+        self.total = sum(sizes.values()) or 1
+        self.parallel = parallel
+        self.done = set()
+        self.running = []
+
+    def _resolve(self, name):
+        if name in self.sizes:
+            return name
+        # finished items are logged without schema
+        for key in self.sizes:
+            if key.split(".", 1)[1] == name:
+                return key
+        return name
+
+    def handle(self, line):
+        match = self.RE_STARTED.search(line)
+        if match:
+            if not self.parallel:
+                self.done.update(self.running)
+                self.running = []
+            self.running.append(self._resolve(match.group(1)))
+            self.output()
+            return
+        match = self.RE_FINISHED.search(line)
+        if match:
+            name = self._resolve(match.group(1))
+            self.done.add(name)
+            if name in self.running:
+                self.running.remove(name)
+            self.output()
+
+    def output(self):
+        done = sum(self.sizes.get(x, 0) for x in self.done)
+        percent = round(done / self.total * 100, 1)
+        current = ", ".join(x.split(".", 1)[-1] for x in self.running[-3:])
+        print(80 * " ", end="\r")
+        print(
+            f"{len(self.done)}/{len(self.sizes)} tables "
+            f"{humanize.naturalsize(done)}/{humanize.naturalsize(self.total)} "
+            f"({percent}%) {current}"[:200],
+            end="\r",
+        )
+
+
+def _backup_directory(
+    host, port, user, dbname, excludes, compression, worker, dest, sizes, pack,
+    codec, level, threads,
+):
+    """
+    Parallel pg_dump in directory format; with pack the directory is put into
+    one tar file (with a codec the compression is done there instead of by
+    pg_dump).
+    """
+    dump_dir = dest.with_name(dest.name + ".dir") if pack else dest
+    _remove_path(dump_dir)
+    if pack and codec:
+        compression = 0
+    cmd = [
+        "pg_dump",
+        "--clean",
+        "--no-owner",
+        "-v",
+        "-h", host,
+        "-p", str(port),
+        "-U", user,
+        f"-Z{compression}",
+        "-Fd",
+        "-j", str(worker),
+        "-f", str(dump_dir),
+    ] + excludes + [dbname]
+
+    started = datetime.now()
+    progress = DumpProgress(sizes, parallel=worker > 1)
+    errors = []
+    process = subprocess.Popen(cmd, stderr=subprocess.PIPE, encoding="utf8")
+    for line in process.stderr:
+        if "error" in line.lower():
+            errors.append(line.strip())
+        progress.handle(line)
+    if process.wait():
+        _remove_path(dump_dir)
+        raise Exception("\n".join(errors) or f"pg_dump failed with {process.returncode}")
+    progress.done.update(sizes)
+    progress.output()
+    print("")
+    click.echo(f"Dump took {(datetime.now() - started).total_seconds()} seconds")
+
+    if pack:
+        try:
+            _pack_directory(dump_dir, dest, codec, level, threads)
+        finally:
+            _remove_path(dump_dir)
+
+
+def _pack_directory(dump_dir, dest, codec, level, threads):
+    started = datetime.now()
+    cmd = f"tar -C {pipes.quote(str(dump_dir))} -cf - . "
+    if codec:
+        compress = _get_compress_cmd(codec, level, threads)
+        cmd += f"| {' '.join(pipes.quote(x) for x in compress)} "
+    cmd += f"> {pipes.quote(str(dest))}"
+    subprocess.check_call(["/bin/bash", "-o", "pipefail", "-c", cmd])
+    click.echo(
+        f"Packed {humanize.naturalsize(dest.stat().st_size)} "
+        f"in {(datetime.now() - started).total_seconds()} seconds"
+    )
+
+
 @postgres.command()
 @click.argument("dbname", required=True)
 @click.argument("host", required=True)
@@ -204,11 +425,19 @@ def backup(
 @click.option("-X", "--exclude-tables", multiple=True)
 @click.option("-v", "--verbose", is_flag=True)
 @click.option("--ignore-errors", is_flag=True)
+@click.option(
+    "--spool",
+    is_flag=True,
+    help="Unzip zipped dumps once in parallel to a spool file to restore with workers",
+)
+@click.option("--spool-dir", help="Where to put the spool file; default beside the dump")
 def restore(
-    dbname, host, port, user, password, filepath, workers, exclude_tables, verbose, ignore_errors
+    dbname, host, port, user, password, filepath, workers, exclude_tables, verbose, ignore_errors,
+    spool, spool_dir,
 ):
     _restore(
-        dbname, host, port, user, password, filepath, workers, exclude_tables, verbose, ignore_errors
+        dbname, host, port, user, password, filepath, workers, exclude_tables, verbose, ignore_errors,
+        spool=spool, spool_dir=spool_dir,
     )
 
 
@@ -223,6 +452,8 @@ def _restore(
     exclude_tables=None,
     verbose=False,
     ignore_errors=False,
+    spool=False,
+    spool_dir=None,
 ):
     click.echo(f"Restoring dump on {host}:{port} as {user}")
     if not dbname:
@@ -237,22 +468,84 @@ def _restore(
     os.system(f"echo \"create database {dbname} ;\" | psql {' '.join(args)} postgres")
 
     PGRESTORE, PSQL = _get_cmd(args)
-    method, needs_unzip = _get_restore_action(filepath, PGRESTORE, PSQL)
+    info = _sniff_dump(filepath)
+    click.echo(f"Dump: {info}")
+    if info.table_count and workers > info.table_count:
+        workers = max(info.table_count, 1)
+    spool_file = None
+    try:
+        if info.content == "tar":
+            # packed directory dump
+            spool_file = Path(spool_dir or Path(filepath).parent) / (
+                "." + Path(filepath).name + ".dir"
+            )
+            _unpack_directory(filepath, spool_file, info.compression, workers)
+            filepath = spool_file
+            info = _sniff_dump(filepath, read_toc=False)
 
+        method, codec = _get_restore_action(
+            filepath, PGRESTORE, PSQL, dump_type=info.dump_type
+        )
+
+        toc = None
+        if spool and codec and method == PGRESTORE and _check_spool_space(filepath, spool_dir):
+            spool_file = Path(spool_dir or Path(filepath).parent) / (
+                "." + Path(filepath).name + ".spool"
+            )
+            toc = _spool_unzipped(filepath, spool_file, codec, workers)
+            filepath = spool_file
+            codec = None
+
+        _restore_file(
+            dbname, host, port, user, password, filepath, workers, exclude_tables,
+            verbose, ignore_errors, PGRESTORE, PSQL, method, codec, toc,
+        )
+    finally:
+        if spool_file:
+            _remove_path(spool_file)
+
+
+def _check_spool_space(filepath, spool_dir):
+    """
+    Spooling writes the unzipped dump; without enough free space the dump
+    is restored from the stream instead.
+    """
+    spool_dir = Path(spool_dir or Path(filepath).parent)
+    if not os.access(spool_dir, os.W_OK):
+        click.secho(f"Cannot write to {spool_dir} - restoring without spool file", fg="yellow")
+        return False
+    estimated = Path(filepath).stat().st_size * SPOOL_RATIO
+    free = shutil.disk_usage(spool_dir).free
+    if free < estimated:
+        click.secho(
+            f"Only {humanize.naturalsize(free)} free in {spool_dir}, about "
+            f"{humanize.naturalsize(estimated)} needed - restoring without spool file",
+            fg="yellow",
+        )
+        return False
+    return True
+
+
+def _restore_file(
+    dbname, host, port, user, password, filepath, workers, exclude_tables,
+    verbose, ignore_errors, PGRESTORE, PSQL, method, codec, toc,
+):
     PREFIX = []
-    if needs_unzip:
-        PREFIX = [next(_get_file("gunzip"))]
-    else:
-        PREFIX = []
+    if codec:
+        PREFIX = _get_decompress_cmd(codec)
     started = datetime.now()
     click.echo("Restoring DB...")
     PV_CMD = " ".join(pipes.quote(s) for s in ["pv", str(filepath)])
-    if workers > 1 and needs_unzip:
+    if workers > 1 and codec:
         workers = 1
-        click.secho("no error, performance note: Cannot use workers as source is unzipped via stdin", fg='yellow')
-    if needs_unzip or method == PSQL or (workers == 1 and not exclude_tables):
-        CMD = PV_CMD + "|" + " ".join(pipes.quote(s) for s in PREFIX)
-        CMD += " | "
+        click.secho("no error, performance note: Cannot use workers as source is unzipped via stdin (see --spool)", fg='yellow')
+    piped = not Path(filepath).is_dir() and (
+        codec or method == PSQL or (workers == 1 and not exclude_tables)
+    )
+    if piped:
+        CMD = PV_CMD + " | "
+        if PREFIX:
+            CMD += " ".join(pipes.quote(s) for s in PREFIX) + " | "
     else:
         CMD = ""
     CMD += " ".join(pipes.quote(s) for s in method)
@@ -266,7 +559,7 @@ def _restore(
             dbname,
         ]
     )
-    if method == PGRESTORE and not needs_unzip:
+    if method == PGRESTORE and not piped:
         CMD += f" '{filepath}' "
 
     if method != PGRESTORE and exclude_tables:
@@ -275,11 +568,11 @@ def _restore(
             "Dump does not support pg_restore"
         )
 
-    if exclude_tables and not needs_unzip:
-        CMD += _get_exclude_table_param(filepath, exclude_tables)
+    if exclude_tables and not codec:
+        CMD += _get_exclude_table_param(filepath, exclude_tables, todolist=toc)
 
-    if workers > 1 and 'pg_restore' in CMD[0]:
-        CMD += ["-j", str(workers)]
+    if workers > 1 and method == PGRESTORE and not piped:
+        CMD += f" -j {workers} "
 
     filename = Path(tempfile.mktemp(suffix=".rc"))
     CMD += f" && echo '1' > {filename}"
@@ -298,10 +591,23 @@ def _restore(
         raise Exception("Did not fully restore.")
 
 
-def _get_exclude_table_param(filepath, exclude_tables):
-    todolist = subprocess.check_output(
-        ["pg_restore", "-l", filepath], encoding="utf8"
-    ).splitlines()
+def _unpack_directory(filepath, dest, codec, workers):
+    _remove_path(dest)
+    dest.mkdir(parents=True)
+    click.echo(f"Unpacking {filepath} to {dest}")
+    cmd = f"pv {pipes.quote(str(filepath))} | "
+    if codec:
+        decompress = _get_decompress_cmd(codec, workers)
+        cmd += f"{' '.join(pipes.quote(x) for x in decompress)} | "
+    cmd += f"tar -C {pipes.quote(str(dest))} -xf -"
+    subprocess.check_call(["/bin/bash", "-o", "pipefail", "-c", cmd])
+
+
+def _get_exclude_table_param(filepath, exclude_tables, todolist=None):
+    if todolist is None:
+        todolist = subprocess.check_output(
+            ["pg_restore", "-l", filepath], encoding="utf8"
+        ).splitlines()
 
     def ok(line):
         if "TABLE DATA public" in line and any(
@@ -316,6 +622,74 @@ def _get_exclude_table_param(filepath, exclude_tables):
     return f" -L '{file}' "
 
 
+def _spool_unzipped(filepath, spool_file, codec, workers):
+    """
+    Unzips the dump (gzip multithreaded with pigz) into spool_file, so that
+    pg_restore can use workers on it. While unzipping the table of contents
+    is read from the same stream; returns its lines.
+    """
+    unzip = _get_decompress_cmd(codec, workers) + [str(filepath)]
+
+    click.echo(f"Unzipping {filepath} to {spool_file}")
+    started = datetime.now()
+    unzipper = subprocess.Popen(unzip, stdout=subprocess.PIPE)
+    toc_reader = subprocess.Popen(
+        ["pg_restore", "-l"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    toc = []
+    toc_thread = Thread(
+        target=lambda: toc.extend(toc_reader.stdout.read().decode("utf8").splitlines())
+    )
+    toc_thread.daemon = True
+    toc_thread.start()
+
+    size = 0
+    last_output = time.time()
+    try:
+        with open(spool_file, "wb") as spool:
+            while True:
+                chunk = unzipper.stdout.read(4 * 1024 * 1024)
+                if not chunk:
+                    break
+                spool.write(chunk)
+                size += len(chunk)
+                if toc_reader.stdin:
+                    # pg_restore -l stops reading after the table of contents
+                    try:
+                        toc_reader.stdin.write(chunk)
+                    except (BrokenPipeError, ValueError):
+                        toc_reader.stdin = None
+                if time.time() - last_output > 5:
+                    last_output = time.time()
+                    seconds = (datetime.now() - started).total_seconds()
+                    print(
+                        f"{humanize.naturalsize(size)} "
+                        f"({humanize.naturalsize(size / seconds)}/s)",
+                        end="\r",
+                    )
+    finally:
+        if toc_reader.stdin:
+            try:
+                toc_reader.stdin.close()
+            except BrokenPipeError:
+                pass
+        unzipper.stdout.close()
+    if unzipper.wait():
+        raise Exception(f"Unzipping {filepath} failed")
+    toc_reader.wait()
+    toc_thread.join()
+
+    seconds = max((datetime.now() - started).total_seconds(), 0.001)
+    tables = len([x for x in toc if "TABLE DATA" in x])
+    click.echo(
+        f"Unzipped {humanize.naturalsize(size)} in {round(seconds)} seconds "
+        f"({humanize.naturalsize(size / seconds)}/s), {tables} tables"
+    )
+    return toc or None
+
+
 def _get_cmd(args):
     PGRESTORE = [
         "pg_restore",
@@ -327,62 +701,311 @@ def _get_cmd(args):
     return PGRESTORE, PSQL
 
 
-def _get_restore_action(filepath, PGRESTORE, PSQL):
+def _get_restore_action(filepath, PGRESTORE, PSQL, dump_type=None):
+    """
+    Returns the restore command and the codec to stream-decompress the dump
+    with (None if not compressed).
+    """
     method = PGRESTORE
-    needs_unzip = True
+    codec = None
 
-    dump_type = __get_dump_type(filepath)
+    dump_type = dump_type or __get_dump_type(filepath)
+    prefix, _, content = dump_type.partition("_")
     if dump_type == "plain_text":
-        needs_unzip = False
-        method = PSQL
-    elif dump_type == "zipped_sql":
         method = PSQL
-        needs_unzip = True
-    elif dump_type == "zipped_pgdump":
+    elif dump_type in ["pgdump", "directory"]:
         pass
-    elif dump_type == "pgdump":
-        needs_unzip = False
+    elif content in ["sql", "pgdump"] and prefix in ["zipped"] + CODECS + ["xz"]:
+        codec = "gzip" if prefix == "zipped" else prefix
+        if content == "sql":
+            method = PSQL
     else:
         raise Exception(f"not impl: {dump_type}")
-    return method, needs_unzip
+    return method, codec
 
 
-def __get_dump_type(filepath):
-    MARKER = "PostgreSQL database dump"
-    first_line = None
-    zipped = False
-    try:
-        with gzip.open(filepath, "r") as f:
-            for line in f:
-                first_line = line.decode("utf-8", errors="ignore")
-                zipped = True
-                break
-    except Exception:  # pylint: disable=broad-except
+COMPRESSION_MAGICS = [
+    (b"\x1f\x8b", "gzip"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"\x04\x22\x4d\x18", "lz4"),
+    (b"\xfd7zXZ\x00", "xz"),
+]
+HEADER_SIZE = 64 * 1024
+ARCHIVE_FORMATS = {1: "custom", 3: "tar", 4: "null", 5: "directory"}
+ARCHIVE_COMPRESSIONS = {0: "none", 1: "gzip", 2: "lz4", 3: "zstd"}
+
+
+class DumpInfo(object):
+    """
+    What is known about a dump from its header: outer compression, content
+    and the metadata of the pg_dump archive (read from the table of contents).
+    """
+
+    def __init__(self):
+        self.compression = None
+        self.content = None
+        self.wodoo_version = None
+        self.archive_version = None
+        self.archive_format = None
+        self.archive_compression = None
+        self.dbname = None
+        self.server_version = None
+        self.pg_dump_version = None
+        self.toc_count = None
+        self.table_count = None
+
+    @property
+    def dump_type(self):
+        if self.content in ["directory", "dump_all"]:
+            return self.content
+        if self.content == "wodoo_bin":
+            return f"wodoo_bin {self.wodoo_version}"
+        if self.content == "tar":
+            if not self.compression:
+                return "tar"
+            return "zipped_tar" if self.compression == "gzip" else f"{self.compression}_tar"
+        if self.content in ["pgdump", "sql"]:
+            if not self.compression:
+                return "pgdump" if self.content == "pgdump" else "plain_text"
+            prefix = "zipped" if self.compression == "gzip" else self.compression
+            return f"{prefix}_{self.content}"
+        return "unzipped_pgdump"
+
+    def __str__(self):
+        values = [f"type: {self.dump_type}"]
+        for name in [
+            "archive_format",
+            "archive_compression",
+            "dbname",
+            "server_version",
+            "pg_dump_version",
+            "table_count",
+        ]:
+            if getattr(self, name) is not None:
+                values.append(f"{name}: {getattr(self, name)}")
+        return ", ".join(values)
+
+
+class _ArchiveReader(object):
+    """
+    Reads the header and table of contents of a pg_dump archive like
+    ReadHead/ReadToc of pg_backup_archiver.c.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.int_size = 4
+        self.off_size = 8
+        self.version = (1, 0, 0)
+
+    def read(self, size):
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise EOFError("Archive header truncated")
+        return data
+
+    def read_byte(self):
+        return self.read(1)[0]
+
+    def read_int(self):
+        sign = self.read_byte() if self.version > (1, 0, 0) else 0
+        value = int.from_bytes(self.read(self.int_size), "little")
+        return -value if sign else value
+
+    def read_str(self):
+        size = self.read_int()
+        if size < 0:
+            return None
+        return self.read(size).decode("utf8", errors="replace")
+
+    def read_header(self, info):
+        if self.read(5) != b"PGDMP":
+            raise ValueError("No pg_dump archive")
+        vmaj, vmin = self.read_byte(), self.read_byte()
+        vrev = self.read_byte() if (vmaj, vmin) > (1, 0) else 0
+        self.version = (vmaj, vmin, vrev)
+        self.int_size = self.read_byte()
+        self.off_size = self.read_byte() if self.version >= (1, 7, 0) else self.int_size
+        archive_format = self.read_byte()
+        info.archive_version = ".".join(map(str, self.version))
+        info.archive_format = ARCHIVE_FORMATS.get(archive_format, str(archive_format))
+
+        if self.version >= (1, 15, 0):
+            algorithm = self.read_byte()
+            info.archive_compression = ARCHIVE_COMPRESSIONS.get(algorithm, str(algorithm))
+        elif self.version >= (1, 2, 0):
+            level = self.read_byte() if self.version < (1, 4, 0) else self.read_int()
+            if level == -1:
+                info.archive_compression = "gzip"
+            else:
+                info.archive_compression = f"gzip {level}" if level else "none"
+
+        if self.version >= (1, 4, 0):
+            for i in range(7):  # creation time
+                self.read_int()
+            info.dbname = self.read_str()
+        if self.version >= (1, 10, 0):
+            info.server_version = self.read_str()
+            info.pg_dump_version = self.read_str()
+        return archive_format
+
+    def read_toc(self, info, archive_format):
+        info.toc_count = self.read_int()
+        table_count = 0
+        for i in range(info.toc_count):
+            self.read_int()  # dump id
+            self.read_int()  # had dumper
+            if self.version >= (1, 8, 0):
+                self.read_str()  # table oid
+            self.read_str()  # oid
+            self.read_str()  # tag
+            desc = self.read_str()
+            if desc == "TABLE DATA":
+                table_count += 1
+            if self.version >= (1, 11, 0):
+                self.read_int()  # section
+            self.read_str()  # definition
+            self.read_str()  # drop statement
+            if self.version >= (1, 3, 0):
+                self.read_str()  # copy statement
+            if self.version >= (1, 6, 0):
+                self.read_str()  # namespace
+            if self.version >= (1, 10, 0):
+                self.read_str()  # tablespace
+            if self.version >= (1, 14, 0):
+                self.read_str()  # table access method
+            if self.version >= (1, 16, 0):
+                self.read_int()  # relkind
+            self.read_str()  # owner
+            if self.version >= (1, 9, 0):
+                self.read_str()  # with oids
+            if self.version >= (1, 5, 0):
+                while self.read_str() is not None:  # dependencies
+                    pass
+            if archive_format == 1:
+                if self.version >= (1, 7, 0):
+                    self.read(1 + self.off_size)  # data offset
+                else:
+                    self.read_int()
+            elif archive_format in [3, 5]:
+                self.read_str()  # data file name
+        info.table_count = table_count
+
+
+class _PrefixedStream(object):
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size):
+        data = self.prefix[:size]
+        self.prefix = self.prefix[size:]
+        if len(data) < size:
+            data += self.stream.read(size - len(data))
+        return data
+
+
+@contextmanager
+def _open_decompressed(filepath, compression):
+    if not compression:
         with open(filepath, "rb") as f:
-            first_line = ""
-            for i in range(2048):
-                t = f.read(1)
-                t = t.decode("utf-8", errors="ignore")
-                first_line += t
-
-    if first_line.startswith("dump_all\n"):
-        return "dump_all"
-
-    if first_line.startswith("WODOO_BIN\n"):
-        version = first_line.split("\n")[1]
-        return f"wodoo_bin {version}"
-
-    if first_line and zipped:
-        if MARKER in first_line or first_line.strip() == "--":
-            return "zipped_sql"
-        if first_line.startswith("PGDMP"):
-            return "zipped_pgdump"
-    elif first_line:
-        if "PGDMP" in first_line:
-            return "pgdump"
-        if MARKER in first_line:
-            return "plain_text"
-    return "unzipped_pgdump"
+            yield f
+    elif compression == "gzip":
+        with gzip.open(filepath, "rb") as f:
+            yield f
+    elif compression == "xz":
+        with lzma.open(filepath, "rb") as f:
+            yield f
+    else:
+        # zstd, lz4: streamed through their command line tools
+        process = subprocess.Popen(
+            [compression, "-dc", str(filepath)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            yield process.stdout
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+
+def _read_archive_info(stream, info, read_toc):
+    reader = _ArchiveReader(stream)
+    try:
+        archive_format = reader.read_header(info)
+        if read_toc:
+            reader.read_toc(info, archive_format)
+    except (EOFError, ValueError, UnicodeDecodeError) as ex:
+        logger.warning(f"Could not read archive header: {ex}")
+
+
+def _sniff_dump(filepath, read_toc=True):
+    """
+    Detects the dump type from the magic numbers of the first bytes, which
+    are read only once; for pg_dump archives the metadata of the table of
+    contents are read, too.
+    """
+    info = DumpInfo()
+    path = Path(filepath)
+    if path.is_dir():
+        info.content = "directory"
+        if (path / "toc.dat").exists():
+            with open(path / "toc.dat", "rb") as f:
+                _read_archive_info(f, info, read_toc)
+        return info
+
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    for magic, compression in COMPRESSION_MAGICS:
+        if header.startswith(magic):
+            info.compression = compression
+
+    stream = None
+    with ExitStack() as stack:
+        if info.compression:
+            try:
+                stream = stack.enter_context(_open_decompressed(path, info.compression))
+                header = stream.read(HEADER_SIZE)
+            except (OSError, EOFError, lzma.LZMAError) as ex:
+                logger.warning(f"Could not decompress {filepath}: {ex}")
+                return info
+
+        if header.startswith(b"dump_all\n"):
+            info.content = "dump_all"
+        elif header.startswith(b"WODOO_BIN\n"):
+            info.content = "wodoo_bin"
+            info.wodoo_version = header.split(b"\n")[1].decode("utf8", errors="ignore")
+        elif header.startswith(b"PGDMP"):
+            info.content = "pgdump"
+            if stream is None:
+                stream = stack.enter_context(open(path, "rb"))
+                stream.seek(len(header))
+            _read_archive_info(_PrefixedStream(header, stream), info, read_toc)
+        elif header[257:262] == b"ustar":
+            if header[:8] == b"toc.dat\x00":
+                # tar format of pg_dump
+                info.content = "pgdump"
+                _read_archive_info(_PrefixedStream(header[512:], io.BytesIO()), info, False)
+            else:
+                info.content = "tar"
+        elif b"PostgreSQL database dump" in header[:4096] or header.startswith(b"--\n"):
+            info.content = "sql"
+            for attribute, regex in [
+                ("server_version", rb"Dumped from database version (\S+)"),
+                ("pg_dump_version", rb"Dumped by pg_dump version (\S+)"),
+            ]:
+                match = re.search(regex, header)
+                if match:
+                    setattr(info, attribute, match.group(1).decode("utf8"))
+        elif not info.compression and b"PGDMP" in header[:2048]:
+            info.content = "pgdump"
+    return info
+
+
+def __get_dump_type(filepath):
+    return _sniff_dump(filepath, read_toc=False).dump_type
 
 
 def _get_file(filename):
@@ -413,8 +1036,170 @@ def autocleanpaper(filepath=None):
                 filepath.unlink()
 
 
+RE_SHA1 = re.compile(r"^[0-9a-f]{40}$")
+
+
+def _get_blob_path(store, sha):
+    return Path(store) / "blobs" / sha[:2] / sha
+
+
+def _file_sha1(path):
+    # odoo names filestore files by the sha1 of their content
+    if RE_SHA1.match(path.name):
+        return path.name
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _snapshot_files(source, store):
+    """
+    Copies the blobs of source, that are not yet in the store and writes a
+    manifest of relative path -> sha1; returns manifest path and statistics.
+    """
+    source, store = Path(source), Path(store)
+    files = {}
+    new_blobs, new_bytes = 0, 0
+    for root, dirs, filenames in os.walk(source):
+        dirs.sort()
+        for filename in sorted(filenames):
+            path = Path(root) / filename
+            sha = _file_sha1(path)
+            files[str(path.relative_to(source))] = sha
+            blob = _get_blob_path(store, sha)
+            if blob.exists():
+                continue
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            temp_blob = blob.with_name("." + blob.name)
+            shutil.copy2(path, temp_blob)
+            temp_blob.replace(blob)
+            new_blobs += 1
+            new_bytes += blob.stat().st_size
+
+    snapshots = store / "snapshots"
+    snapshots.mkdir(parents=True, exist_ok=True)
+    manifest = snapshots / f"{datetime.now().strftime('%Y%m%d_%H%M%S')}.manifest"
+    manifest.write_text(
+        json.dumps({"source": str(source), "files": files})
+    )
+    return manifest, len(files), new_blobs, new_bytes
+
+
+def _prune_snapshots(store, keep):
+    store = Path(store)
+    manifests = sorted((store / "snapshots").glob("*.manifest"))
+    for manifest in manifests[:-keep]:
+        manifest.unlink()
+    used = set()
+    for manifest in manifests[-keep:]:
+        used.update(json.loads(manifest.read_text())["files"].values())
+    removed = 0
+    for blob in (store / "blobs").glob("*/*"):
+        if blob.name not in used:
+            blob.unlink()
+            removed += 1
+    return removed
+
+
+def _assemble_snapshot(manifest, dest, store=None):
+    """
+    Rebuilds the file tree of a snapshot by hardlinking the blobs.
+    """
+    manifest = Path(manifest)
+    data = json.loads(manifest.read_text())
+    # manifests are kept in STORE/snapshots, so the store moves with them
+    store = Path(store or manifest.absolute().parent.parent)
+    dest = Path(dest)
+    for relpath, sha in data["files"].items():
+        path = dest / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        blob = _get_blob_path(store, sha)
+        try:
+            os.link(blob, path)
+        except OSError:
+            # other filesystem
+            shutil.copy2(blob, path)
+
+
+@postgres.command(name="snapshot-files")
+@click.argument("source", required=True)
+@click.argument("store", required=True)
+@click.option("--keep", type=int, help="Keep only the last n snapshots and their blobs")
+def snapshot_files(source, store, keep):
+    """
+    Incremental, deduplicated snapshot of a filestore into store.
+    """
+    started = datetime.now()
+    manifest, count, new_blobs, new_bytes = _snapshot_files(source, store)
+    click.echo(
+        f"Snapshot {manifest}: {count} files, {new_blobs} new blobs "
+        f"({humanize.naturalsize(new_bytes)}) in "
+        f"{(datetime.now() - started).total_seconds()} seconds"
+    )
+    if keep:
+        removed = _prune_snapshots(store, keep)
+        click.echo(f"Removed {removed} unused blobs")
+
+
+@postgres.command(name="restore-files")
+@click.argument("manifest", required=True)
+@click.argument("dest", required=True)
+@click.option("--store", help="Blob store, if the manifest is not in STORE/snapshots")
+def restore_files(manifest, dest, store):
+    """
+    Rebuilds the filestore of a snapshot manifest in dest.
+    """
+    _assemble_snapshot(manifest, dest, store=store)
+
+
+@postgres.command(name="dump-all")
+@click.argument("dbdump", required=True)
+@click.argument("files", required=True)
+@click.argument("dest", required=True)
+@click.option(
+    "--snapshot-store",
+    help=(
+        "Snapshot the files incrementally into this store and embed only the manifest; "
+        "keep the store (and enough snapshots with --keep) as long as the dump"
+    ),
+)
+def dump_all(dbdump, files, dest, snapshot_store):
+    """
+    Packs a database dump and the files into one dump_all file.
+    """
+    dest = Path(dest).absolute()
+    temp_dest = dest.with_name("." + dest.name)
+    with open(temp_dest, "wb") as f:
+        f.write(b"dump_all\n")
+        with tarfile.open(fileobj=f, mode="w|gz") as tar:
+            tar.add(str(dbdump), arcname="db")
+            if snapshot_store:
+                manifest, count, new_blobs, new_bytes = _snapshot_files(files, snapshot_store)
+                click.echo(
+                    f"Snapshot {manifest}: {count} files, {new_blobs} new blobs "
+                    f"({humanize.naturalsize(new_bytes)})"
+                )
+                data = json.loads(manifest.read_text())
+                # resolved relative to the dump_all file on extract
+                data["store"] = os.path.relpath(Path(snapshot_store).absolute(), dest.parent)
+                with autocleanpaper() as embedded:
+                    embedded.write_text(json.dumps(data))
+                    tar.add(str(embedded), arcname="files.manifest")
+            else:
+                tar.add(str(files), arcname="files")
+    temp_dest.replace(dest)
+    click.echo(f"Written {dest}")
+
+
 @contextmanager
-def extract_dumps_all(tmppath, filepath):
+def extract_dumps_all(tmppath, filepath, store=None):
+    """
+    Extracts db and files of a dump_all; files contained as snapshot
+    manifest are rebuilt from the blob store by hardlinking.
+    """
+    tmppath = Path(tmppath)
     with autocleanpaper() as scriptfile:
         lendumpall = len("dump_all") + 2
         scriptfile.write_text(
@@ -429,8 +1214,26 @@ def extract_dumps_all(tmppath, filepath):
             )
         )
         subprocess.check_call(["/bin/bash", scriptfile])
+        manifest = tmppath / "files.manifest"
+        if manifest.exists() and not (tmppath / "files").exists():
+            if not store:
+                store = Path(filepath).absolute().parent / json.loads(manifest.read_text())["store"]
+            _assemble_snapshot(manifest, tmppath / "files", store=store)
         yield tmppath / "db", tmppath / "files"
 
 
+@postgres.command(name="extract-dump-all")
+@click.argument("filepath", required=True)
+@click.argument("dest", required=True)
+@click.option("--store", help="Blob store of embedded snapshots, if moved since the dump")
+def extract_dump_all(filepath, dest, store):
+    """
+    Extracts db and files of a dump_all into dest (emptied before).
+    """
+    with extract_dumps_all(Path(dest), filepath, store=store) as (db, files):
+        click.echo(f"Database dump: {db}")
+        click.echo(f"Files: {files}")
+
+
 if __name__ == "__main__":
     postgres()
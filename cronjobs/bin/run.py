@@ -1,5 +1,6 @@
 #!/usr/bin/python3
-import arrow
+import heapq
+import itertools
 import threading
 import string
 import os
@@ -7,16 +8,29 @@ import sys
 import time
 import logging
 import subprocess
-from croniter import croniter
-from croniter import CroniterBadCronError
 from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 import click
+from tabulate import tabulate
+from job_ledger import JobLedger
+import cron_schedule
+from odoo_executor import OdooExecutor
+from odoo_executor import get_args as get_odoo_args
+from cron_metrics import CronMetrics
 
 FORMAT = "[%(levelname)s] %(name) -12s %(asctime)s %(message)s"
 logging.basicConfig(format=FORMAT)
 logging.getLogger().setLevel(logging.DEBUG)
 logger = logging.getLogger("")  # root handler
 
+# the scheduler wakes up at least that often to notice changes of the clock
+MAX_SLEEP = 60
+# what happens if a job is due while it is still running
+POLICIES = ["skip-if-running", "queue", "allow-parallel"]
+RUN_DIR = Path(os.getenv("CRON_RUN_DIR") or "/opt/cronjobs")
+odoo_executor = None
+
 
 @click.group()
 def cli():
@@ -31,55 +45,165 @@ def get_jobs():
             if not job:
                 continue
 
-            # either 5 or 6 columns; it supports seconds
-            schedule = job
-            while schedule:
-                try:
-                    croniter(schedule, now)
-                except Exception:
-                    schedule = schedule[:-1]
-                else:
-                    break
-            if not schedule:
-                raise Exception(f"Invalid schedule: {job}")
-            job_command = job[len(schedule) :].strip()
-            itr = croniter(schedule, now)
+            name = key.replace("CRONJOB_", "")
+            try:
+                schedule, job_command = cron_schedule.parse(job, tz=os.getenv("CRON_TZ"))
+            except cron_schedule.ScheduleError as ex:
+                raise Exception(f"Invalid job {name}: {ex}")
+            policy, groups, catchup = _get_job_settings(name)
             yield {
-                "name": key.replace("CRONJOB_", ""),
+                "name": name,
                 "schedule": schedule,
                 "cmd": job_command,
                 "base": now,
-                "next": itr.get_next(datetime),
+                "next": schedule.get_next(now),
+                "policy": policy,
+                "groups": groups,
+                "catchup": catchup,
             }
 
 
-def replace_params(text):
-    # replace params in there
-    def _replace_params(text):
-        text = string.Template(text).substitute(os.environ)
-        text = text.format(
-            project_name=os.environ["PROJECT_NAME"],
-            customs=os.environ["PROJECT_NAME"],
-            date=datetime.now(),
-        )
+def _get_job_settings(name):
+    """
+    CRON_POLICY_<job>: one of POLICIES, default from CRON_POLICY
+    CRON_GROUPS_<job>: comma separated resource groups; jobs of the same
+    group do not run at the same time e.g. CRON_GROUPS_BACKUP=postgres
+    CRON_CATCHUP_<job>: 1 to run once at startup, if runs were missed while
+    the daemon was down; default from CRON_CATCHUP
+    """
+    policy = os.getenv(f"CRON_POLICY_{name}") or os.getenv("CRON_POLICY") or POLICIES[0]
+    if policy not in POLICIES:
+        raise Exception(f"Invalid policy for {name}: {policy}; allowed: {POLICIES}")
+    groups = os.getenv(f"CRON_GROUPS_{name}") or ""
+    groups = sorted(set(x.strip() for x in groups.split(",") if x.strip()))
+    catchup = (os.getenv(f"CRON_CATCHUP_{name}") or os.getenv("CRON_CATCHUP")) == "1"
+    return policy, groups, catchup
+
+
+def get_ledger():
+    return JobLedger(RUN_DIR / "history.sqlite")
+
+
+class _Deferred(object):
+    """
+    Keeps a format field like {date} or {date:%Y%m%d} for the fire time.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return _Deferred(f"{self.name}.{attr}")
+
+    def __getitem__(self, key):
+        return _Deferred(f"{self.name}[{key}]")
+
+    def __format__(self, spec):
+        return "{" + self.name + (f":{spec}" if spec else "") + "}"
+
+
+class CommandTemplate(object):
+    """
+    Job command with the environment substituted once; only the dynamic
+    fields (date) are filled when rendered.
+    """
+
+    DYNAMIC = ["date"]
+
+    def __init__(self, text, environ):
+        self.source = text
+        self.static = {
+            "project_name": environ["PROJECT_NAME"],
+            "customs": environ["PROJECT_NAME"],
+        }
+        self.template = self._compile(text, environ)
+        self.environ = environ
+
+    def _compile(self, text, environ):
+        fields = dict(self.static, **{x: _Deferred(x) for x in self.DYNAMIC})
+
+        def _replace_params(text):
+            text = string.Template(text).substitute(environ)
+            return text.format(**fields)
+
+        while True:
+            text = _replace_params(text)
+            if _replace_params(text) == text:
+                break
         return text
 
-    while True:
-        text = _replace_params(text)
-        if _replace_params(text) == text:
-            break
-    return text
+    def render(self, now=None):
+        return self.template.format(date=now or datetime.now(), **self.static)
+
+    def dependencies(self, text=None, stack=()):
+        """
+        Tree of the substituted environment variables: [(name, value, [...])]
+        """
+        result = []
+        names = []
+        for match in string.Template.pattern.finditer(self.source if text is None else text):
+            name = match.group("named") or match.group("braced")
+            if name and name not in names:
+                names.append(name)
+        for name in names:
+            value = self.environ.get(name)
+            children = []
+            if name not in stack and value:
+                children = self.dependencies(value, stack + (name,))
+            result.append((name, value, children))
+        return result
+
+
+_templates = {}
+
+
+def compile_command(text):
+    if text not in _templates:
+        _templates[text] = CommandTemplate(text, os.environ)
+    return _templates[text]
+
+
+def replace_params(text):
+    return compile_command(text).render()
+
+
+def _pass_output(stream):
+    output_size = 0
+    for chunk in iter(lambda: stream.read1(65536), b""):
+        output_size += len(chunk)
+        sys.stdout.buffer.write(chunk)
+        sys.stdout.buffer.flush()
+    return output_size
 
 
 def execute(job_cmd):
+    """
+    Runs the job command with its output passed through; returns the exit
+    code and the size of the output.
+    """
     logger.info(f"Executing: {job_cmd}")
 
-    job_cmd = replace_params(job_cmd)
+    job_cmd = compile_command(job_cmd).render()
     if job_cmd.startswith("odoo "):
+        args = get_odoo_args(job_cmd)
+        if odoo_executor and args is not None:
+            output_size = []
+            rc = odoo_executor.run(
+                ["-p", os.environ["PROJECT_NAME"]] + args,
+                "/opt/src",
+                os.environ,
+                lambda stream: output_size.append(_pass_output(stream)),
+            )
+            if rc is not None:
+                return rc, sum(output_size)
         job_cmd = (
             "cd /opt/src;" "odoo " f"-p {os.environ['PROJECT_NAME']} " f"{job_cmd[5:]}"
         )
-    os.system(job_cmd)
+    process = subprocess.Popen(
+        job_cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    output_size = _pass_output(process.stdout)
+    return process.wait(), output_size
 
 
 @cli.command(name="run")
@@ -94,30 +218,145 @@ def run_job(job):
             click.secho(f"Job: {job['name']}")
         sys.exit(-1)
     cmd = found[0]["cmd"]
-    execute(cmd)
+    rc, _ = execute(cmd)
+    sys.exit(rc)
 
 
-def _run_job(job):
-    i = 0
-    try:
-        while True:
-            now = datetime.now()
+@cli.command()
+@click.argument("job", required=True)
+def explain(job):
+    """
+    Shows the resolved command of the job and where its values come from.
+    """
+    jobs = {x["name"]: x for x in get_jobs()}
+    if job not in jobs:
+        click.secho(f"Job not found: {job}", fg="red")
+        sys.exit(-1)
+    job = jobs[job]
+    template = compile_command(job["cmd"])
+    click.secho(f"Schedule: {job['schedule']}")
+    click.secho(f"Next run: {job['next']}")
+    click.secho(f"Command:  {job['cmd']}")
+    click.secho(f"Compiled: {template.template}", fg="blue")
+    click.secho(f"Now:      {template.render()}", fg="green")
+
+    def output(dependencies, depth):
+        for name, value, children in dependencies:
+            click.echo(f"{'  ' * depth}${name} = {value}")
+            output(children, depth + 1)
+
+    click.secho("Dependencies:")
+    output(template.dependencies(), 1)
+
 
-            if i > 300:
-                logging.info("Next run of %s at %s", job["cmd"], job["next"])
-                i = 0
+class Scheduler(object):
+    """
+    One loop over a heap of next fire times; it sleeps until the earliest
+    job is due and hands it over to a pool of worker threads. At most
+    max_jobs jobs execute at the same time; jobs, that wait for their
+    previous run or their resource groups, wait in the pool.
+    """
 
-            if job["next"] < now:
-                execute(job["cmd"])
+    def __init__(self, jobs, max_jobs, ledger, metrics):
+        self.ledger = ledger
+        self.metrics = metrics
+        self.heap = []
+        self.counter = itertools.count()
+        # waiting jobs occupy a thread: per job one running and one queued
+        self.pool = ThreadPoolExecutor(max_workers=max(2 * len(jobs), max_jobs, 1))
+        self.slots = threading.BoundedSemaphore(max_jobs)
+        self.lock = threading.Lock()
+        self.active = {}  # submitted and not finished runs per job
+        self.job_locks = {}
+        self.group_locks = {}
+        for job in jobs:
+            self.active[job["name"]] = 0
+            self.job_locks[job["name"]] = threading.Lock()
+            for group in job["groups"]:
+                self.group_locks.setdefault(group, threading.Lock())
+            self._catchup(job)
+            self._push(job)
+
+    def _catchup(self, job):
+        if not job["catchup"]:
+            return
+        last = self.ledger.last_planned(job["name"])
+        if not last:
+            return
+        missed = job["schedule"].get_next(last)
+        if missed < job["base"]:
+            logger.info("Catching up %s, missed run at %s", job["name"], missed)
+            job["next"] = job["base"]
 
-                itr = croniter(job["schedule"], arrow.get().naive)
-                job["next"] = itr.get_next(datetime)
+    def _push(self, job):
+        logger.debug("Next run of %s at %s", job["name"], job["next"])
+        self.metrics.scheduled(job["name"], job["next"])
+        # the counter keeps jobs with the same fire time in order
+        heapq.heappush(self.heap, (job["next"], next(self.counter), job))
 
-            time.sleep(1)
-            i += 1
-    except Exception as ex:
-        logger.error(ex)
-        time.sleep(1)
+    def _admit(self, job):
+        with self.lock:
+            active = self.active[job["name"]]
+            if job["policy"] == "skip-if-running" and active:
+                logger.warning("Skipping %s - previous run not finished", job["name"])
+                self.metrics.skipped(job["name"])
+                return False
+            if job["policy"] == "queue" and active > 1:
+                logger.warning("Skipping %s - already queued", job["name"])
+                self.metrics.skipped(job["name"])
+                return False
+            self.active[job["name"]] += 1
+            return True
+
+    def _execute(self, job, planned, fired):
+        locks = []
+        if job["policy"] != "allow-parallel":
+            locks.append(self.job_locks[job["name"]])
+        # always acquired in the same order, so jobs cannot deadlock
+        locks += [self.group_locks[x] for x in job["groups"]]
+        acquired = []
+        try:
+            for lock in locks:
+                lock.acquire()
+                acquired.append(lock)
+            with self.slots:
+                started = datetime.now()
+                self.metrics.started(job["name"], (started - fired).total_seconds())
+                run_id = self.ledger.start(job["name"], planned)
+                rc, output_size = None, None
+                try:
+                    rc, output_size = execute(job["cmd"])
+                finally:
+                    self.ledger.finish(run_id, rc, output_size)
+                    duration = (datetime.now() - started).total_seconds()
+                    self.metrics.finished(job["name"], rc if rc is not None else -1, duration)
+                if rc:
+                    logger.error("Job %s failed with exit code %s", job["name"], rc)
+        except Exception as ex:  # pylint: disable=broad-except
+            logger.error(ex)
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            with self.lock:
+                self.active[job["name"]] -= 1
+
+    def run(self):
+        while True:
+            now = datetime.now()
+            if not self.heap:
+                time.sleep(MAX_SLEEP)
+                continue
+            due, _, job = self.heap[0]
+            if due > now:
+                time.sleep(min((due - now).total_seconds(), MAX_SLEEP))
+                continue
+            heapq.heappop(self.heap)
+            self.metrics.dispatched(job["name"], due, now)
+            if self._admit(job):
+                self.pool.submit(self._execute, job, due, now)
+
+            job["next"] = job["schedule"].get_next(datetime.now())
+            self._push(job)
 
 
 @cli.command()
@@ -125,7 +364,7 @@ def daemon():
     logging.info("Starting daemon")
     jobs = list(get_jobs())
     for job in jobs:
-        logging.info("Job: %s", job["name"])
+        logging.info("Job: %s (%s) %s", job["name"], job["policy"], ",".join(job["groups"]))
 
     for job in jobs:
         logging.info("Scheduling Job: %s", job)
@@ -136,12 +375,50 @@ def daemon():
     for job in jobs:
         logger.info(replace_params(job["cmd"]))
 
-        t = threading.Thread(target=_run_job, args=(job,))
-        t.daemon = True
-        t.start()
+    ledger = get_ledger()
+    ledger.prune(int(os.getenv("CRON_HISTORY_DAYS") or 90))
+    if os.getenv("CRON_WARM_ODOO") == "1":
+        global odoo_executor
+        odoo_executor = OdooExecutor(RUN_DIR / "odoo_executor.sock")
+        odoo_executor.start()
+    metrics = CronMetrics()
+    if os.getenv("CRON_METRICS_PORT"):
+        logger.info("Serving metrics on port %s", os.environ["CRON_METRICS_PORT"])
+        metrics.serve(int(os.environ["CRON_METRICS_PORT"]))
+    max_jobs = int(os.getenv("CRON_WORKERS") or 4)
+    Scheduler(jobs, max_jobs, ledger, metrics).run()
+
+
+@cli.command()
+@click.argument("job", required=False)
+@click.option("-n", "--limit", default=0, help="Show the last n runs of the job")
+def history(job, limit):
+    ledger = get_ledger()
+    if limit:
+        rows = [
+            (
+                name, started, finished,
+                round((finished - started).total_seconds(), 1) if finished else None,
+                rc, output_size,
+            )
+            for name, planned, started, finished, rc, output_size in ledger.runs(job, limit)
+        ]
+        click.echo(tabulate(
+            rows, ["job", "started", "finished", "seconds", "rc", "output"]
+        ))
+        return
 
-    while True:
-        time.sleep(10000000)
+    rows = []
+    for name, data in sorted(ledger.stats(job).items()):
+        rows.append((
+            name, data["runs"], data["failed"], data["unfinished"],
+            data["p50"], data["p95"], data["max"],
+            data["last_started"], data["last_rc"],
+        ))
+    click.echo(tabulate(rows, [
+        "job", "runs", "failed", "unfinished", "p50 [s]", "p95 [s]", "max [s]",
+        "last run", "last rc",
+    ]))
 
 
 if __name__ == "__main__":
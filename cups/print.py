@@ -1,6 +1,27 @@
 #!/usr/bin/env python3
+# Prints the pdf files put into PATH/<printer queue>/ and moves them to
+# PRINTED, once cups accepted the job.
+#
+# New files are noticed by inotify when they are closed. Every printer
+# queue is served by its own thread with its own cups connection, so a
+# stopped printer does not delay the others: at most MAX_INFLIGHT jobs are
+# submitted per queue, and a queue whose printer is stopped or unreachable
+# waits with exponential backoff.
+#
+# Queues listed in BATCHING collect their files for a short window and
+# print them, merged by pdfunite, as one cups job.
 from pathlib import Path
+import ctypes
+import ctypes.util
+import json
+import queue
+import select
+import subprocess
+import tempfile
+import struct
 import time
+import threading
+from collections import deque
 import uuid
 import traceback
 import logging
@@ -24,21 +45,406 @@ if not PATH.exists():
 if not PRINTED.exists():
     raise Exception("Path Printed required!")
 
-while True:
-    try:
+# jobs per queue, that cups has accepted but not finished
+MAX_INFLIGHT = int(os.getenv("MAX_INFLIGHT") or 10)
+# seconds after which an unfinished job does not count as in flight anymore
+JOB_MAX_AGE = int(os.getenv("JOB_MAX_AGE") or 3600)
+# seconds to wait after the first failure; doubled up to BACKOFF_MAX
+BACKOFF_START = 2
+BACKOFF_MAX = int(os.getenv("BACKOFF_MAX") or 300)
+# seconds between the checks of the job states
+TRACK_INTERVAL = 2
+# seconds between the statistics in the log; written to STATS_FILE if set
+STATS_INTERVAL = int(os.getenv("STATS_INTERVAL") or 60)
+STATS_FILE = os.getenv("STATS_FILE")
 
-        for file in PATH.glob("**/*.pdf"):
-            printer_queue = file.parent.name
-            id = str(uuid.uuid4()).replace(u'-', u'')
-            conn = cups.Connection()
-            logger.info(u"Printing {} to queue: {}".format(file, printer_queue))
+
+def _parse_batching(text):
+    """
+    "<queue>:<max files>:<window ms>,..." to {queue: (max files, window seconds)}
+    """
+    result = {}
+    for item in (text or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, max_files, window = item.rsplit(":", 2)
+        result[name] = (max(1, int(max_files)), int(window) / 1000.0)
+    return result
+
+
+# other queues print every file as its own job
+BATCHING = _parse_batching(os.getenv("BATCHING"))
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+JOB_STATES = {
+    3: "pending",
+    4: "held",
+    5: "processing",
+    6: "stopped",
+    7: "canceled",
+    8: "aborted",
+    9: "completed",
+}
+FINISHED_STATES = [7, 8, 9]
+PRINTER_STOPPED = 5
+IPP_NOT_FOUND = getattr(cups, "IPP_NOT_FOUND", 0x0406)
+
+
+def _is_not_found(ex):
+    return isinstance(ex, cups.IPPError) and ex.args and ex.args[0] == IPP_NOT_FOUND
+
+
+class Inotify(object):
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.paths = {}
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, str(path).encode("utf-8"), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed: {}".format(path))
+        self.paths[wd] = Path(path)
+
+    def read(self, timeout):
+        """
+        Returns the events as (path, mask) within timeout seconds.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, size = struct.unpack_from("iIII", data, pos)
+            pos += 16
+            name = data[pos:pos + size].rstrip(b"\0").decode("utf-8")
+            pos += size
+            if mask & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            if wd in self.paths and name:
+                events.append((self.paths[wd] / name, mask))
+        return events
+
+
+class PrinterQueue(object):
+    def __init__(self, name, printed):
+        self.name = name
+        self.printed = printed
+        self.incoming = queue.Queue()
+        self.backlog = deque()  # (file, time of arrival)
+        self.queued = set()
+        self.jobs = {}  # cups job id: (file names, submitted)
+        self.batch_size, self.batch_window = BATCHING.get(name, (1, 0))
+        self.connection = None
+        self.failures = 0
+        self.backoff_until = 0
+        self.last_tracked = 0
+        self.submitted = 0
+        self.files_submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.unknown = 0
+        self.expired = 0
+        self.finished = deque()  # end times of the jobs of the last minute
+        self.last_finished = time.time()
+        self.full_since = None
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def add(self, file):
+        self.incoming.put(file)
+
+    def _get_connection(self):
+        if not self.connection:
+            self.connection = cups.Connection()
+        return self.connection
+
+    def _fail(self, reason, reconnect=True):
+        delay = min(BACKOFF_MAX, BACKOFF_START * 2 ** self.failures)
+        self.failures += 1
+        self.backoff_until = time.time() + delay
+        if reconnect:
+            self.connection = None
+        logger.warning(u"Queue {} paused for {} seconds: {}".format(self.name, delay, reason))
+
+    def _printer_ready(self):
+        try:
+            attributes = self._get_connection().getPrinterAttributes(
+                self.name,
+                requested_attributes=["printer-state", "printer-is-accepting-jobs"],
+            )
+        except Exception as ex:
+            self._fail(u"printer state not available: {}".format(ex))
+            return False
+        if attributes.get("printer-state") == PRINTER_STOPPED:
+            self._fail(u"printer is stopped", reconnect=False)
+            return False
+        if not attributes.get("printer-is-accepting-jobs", True):
+            self._fail(u"printer is not accepting jobs", reconnect=False)
+            return False
+        return True
+
+    def _take_incoming(self, timeout):
+        try:
+            file = self.incoming.get(timeout=timeout)
+            while True:
+                if file not in self.queued:
+                    self.queued.add(file)
+                    self.backlog.append((file, time.time()))
+                file = self.incoming.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _merge(self, files):
+        fd, merged = tempfile.mkstemp(prefix="batch-", suffix=".pdf")
+        os.close(fd)
+        process = subprocess.run(
+            ["pdfunite"] + [str(x) for x in files] + [merged],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        )
+        if process.returncode:
+            logger.warning(u"Could not merge {} files for {}: {}".format(
+                len(files), self.name, process.stdout.decode("utf-8", errors="replace"),
+            ))
+            os.unlink(merged)
+            return None
+        return merged
+
+    def _submit(self, files):
+        """
+        Prints the files as one job; returns the count of printed files.
+        """
+        merged = None
+        if len(files) > 1:
+            merged = self._merge(files)
+            if not merged:
+                # one broken file must not stop the others
+                files = files[:1]
+        document = merged or str(files[0])
+        names = [x.name for x in files]
+        id = str(uuid.uuid4()).replace(u'-', u'')
+        logger.info(u"Printing {} to queue: {}".format(", ".join(names), self.name))
+        try:
+            job_id = self._get_connection().printFile(str(self.name), document, str(id), {})
+        except Exception:
+            msg = traceback.format_exc()
+            logger.error(msg)
+            self._fail(u"printing {} failed".format(", ".join(names)))
+            return 0
+        finally:
+            if merged:
+                os.unlink(merged)
+        self.jobs[job_id] = (names, time.time())
+        self.submitted += 1
+        self.files_submitted += len(files)
+        for file in files:
+            file.rename(self.printed / file.name)
+        logger.info(u"Job {} accepted for {}".format(job_id, ", ".join(names)))
+        return len(files)
+
+    def _next_batch(self, now):
+        """
+        Files of the next job or None, while the batching window is open.
+        """
+        if not self.backlog:
+            return None
+        if len(self.backlog) < self.batch_size and now - self.backlog[0][1] < self.batch_window:
+            return None
+        return [file for file, _ in list(self.backlog)[:self.batch_size]]
+
+    def _pop(self, count):
+        for _ in range(count):
+            file, _ = self.backlog.popleft()
+            self.queued.discard(file)
+
+    def _submit_backlog(self):
+        ready = False
+        while self.backlog and len(self.jobs) < MAX_INFLIGHT:
+            batch = self._next_batch(time.time())
+            if not batch:
+                return
+            files = [x for x in batch if x.exists()]
+            if not files:
+                self._pop(len(batch))
+                continue
+            if not ready:
+                ready = self._printer_ready()
+                if not ready:
+                    return
+            printed = self._submit(files)
+            if not printed:
+                return
+            if printed < len(files):
+                # merging failed, only the first file was printed
+                self._pop(batch.index(files[0]) + 1)
+            else:
+                self._pop(len(batch))
+            self.failures = 0
+
+    def _finished(self):
+        self.last_finished = time.time()
+        self.finished.append(self.last_finished)
+
+    def _track_jobs(self):
+        for job_id, (names, submitted) in list(self.jobs.items()):
+            if time.time() - submitted > JOB_MAX_AGE:
+                # a lost job id must not block the queue forever
+                del self.jobs[job_id]
+                self._finished()
+                self.expired += 1
+                logger.warning(u"Job {} of {} on {} not finished after {} seconds - not tracked anymore".format(
+                    job_id, ", ".join(names), self.name, JOB_MAX_AGE,
+                ))
+                continue
+            try:
+                attributes = self._get_connection().getJobAttributes(
+                    job_id, requested_attributes=["job-state"]
+                )
+            except Exception as ex:
+                if _is_not_found(ex):
+                    # purged from the job history or lost by a restart of cups
+                    del self.jobs[job_id]
+                    self._finished()
+                    self.unknown += 1
+                    logger.warning(u"Job {} of {} on {} is unknown to cups - not tracked anymore".format(
+                        job_id, ", ".join(names), self.name,
+                    ))
+                else:
+                    logger.warning(u"Could not get state of job {}: {}".format(job_id, ex))
+                    self.connection = None
+                continue
+            state = attributes.get("job-state")
+            if state in FINISHED_STATES:
+                del self.jobs[job_id]
+                self._finished()
+                if state == 9:
+                    self.completed += 1
+                    log = logger.info
+                else:
+                    self.failed += 1
+                    log = logger.error
+                log(u"Job {} of {} on {} {} after {} seconds".format(
+                    job_id, ", ".join(names), self.name, JOB_STATES[state],
+                    round(time.time() - submitted, 1),
+                ))
+
+    def run(self):
+        while True:
+            try:
+                timeout = 0.5
+                if self.backlog and self.batch_window:
+                    # wake up, when the batching window closes
+                    remaining = self.backlog[0][1] + self.batch_window - time.time()
+                    if 0 < remaining < timeout:
+                        timeout = remaining
+                self._take_incoming(timeout=timeout)
+                now = time.time()
+                # a full queue is checked more often to submit the next files
+                interval = 0.5 if len(self.jobs) >= MAX_INFLIGHT else TRACK_INTERVAL
+                if self.jobs and now - self.last_tracked > interval:
+                    self.last_tracked = now
+                    self._track_jobs()
+                if now >= self.backoff_until:
+                    self._submit_backlog()
+                if len(self.jobs) < MAX_INFLIGHT:
+                    self.full_since = None
+                elif not self.full_since:
+                    self.full_since = now
+            except Exception:
+                msg = traceback.format_exc()
+                logger.error(msg)
+                time.sleep(2)
+
+    def stats(self):
+        now = time.time()
+        while self.finished and self.finished[0] < now - 60:
+            self.finished.popleft()
+        return {
+            "backlog": len(self.backlog) + self.incoming.qsize(),
+            "in_flight": len(self.jobs),
+            "submitted": self.submitted,
+            "files_submitted": self.files_submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "unknown": self.unknown,
+            "expired": self.expired,
+            "jobs_per_minute": len(self.finished),
+            "paused_seconds": max(0, round(self.backoff_until - now)),
+            # full queue without any finished job
+            "stalled_seconds": round(now - max(self.full_since, self.last_finished)) if self.full_since else 0,
+        }
+
+
+class Spooler(object):
+    def __init__(self, path, printed):
+        self.path = path
+        self.printed = printed
+        self.inotify = Inotify()
+        self.queues = {}
+        self.last_stats = time.time()
+
+    def watch_dir(self, directory):
+        self.inotify.add_watch(directory, WATCH_MASK)
+        # files, that were there before the watch
+        for path in sorted(directory.iterdir(), key=lambda x: x.stat().st_mtime):
+            if path.is_dir():
+                self.watch_dir(path)
+            else:
+                self.add(path)
+
+    def add(self, file):
+        if file.suffix != ".pdf":
+            return
+        printer_queue = file.parent.name
+        if printer_queue not in self.queues:
+            self.queues[printer_queue] = PrinterQueue(printer_queue, self.printed)
+        self.queues[printer_queue].add(file)
+
+    def report(self):
+        stats = {name: q.stats() for name, q in sorted(self.queues.items())}
+        for name, data in sorted(stats.items()):
+            logger.info(u"Queue {}: {}".format(name, ", ".join(
+                "{}={}".format(key, value) for key, value in sorted(data.items())
+            )))
+            if data["stalled_seconds"] >= STATS_INTERVAL:
+                logger.warning(u"Queue {} stalled: {} jobs in flight and none finished for {} seconds".format(
+                    name, data["in_flight"], data["stalled_seconds"],
+                ))
+        if STATS_FILE:
+            tmp = STATS_FILE + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"time": time.time(), "queues": stats}, f, indent=2)
+            os.rename(tmp, STATS_FILE)
+
+    def run(self):
+        self.watch_dir(self.path)
+        while True:
             try:
-                conn.printFile(str(printer_queue), str(file), str(id), {})
-                file.rename(PRINTED / file.name)
+                for path, mask in self.inotify.read(timeout=1):
+                    if mask & IN_ISDIR:
+                        if mask & (IN_CREATE | IN_MOVED_TO):
+                            self.watch_dir(path)
+                    elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        self.add(path)
+                if time.time() - self.last_stats > STATS_INTERVAL:
+                    self.last_stats = time.time()
+                    self.report()
             except Exception:
                 msg = traceback.format_exc()
                 logger.error(msg)
-    except Exception:
-        msg = traceback.format_exc()
-        logger.error(msg)
-    time.sleep(2)
+                time.sleep(2)
+
+
+Spooler(PATH, PRINTED).run()
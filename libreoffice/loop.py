@@ -1,20 +1,68 @@
 #!/usr/bin/python3
+# Converts the files put into INPUT to pdf into OUTPUT.
+#
+# New files are noticed by inotify (polling as fallback) and converted by a
+# pool of pre-started soffice instances, that are connected over UNO sockets.
+# Without python3-uno every batch is converted by a fresh soffice process.
+#
+# The result of every file is written to OUTPUT/manifest.json; inputs, that
+# could not be converted, are moved to QUARANTINE.
+#
+# Results are cached by the sha256 of the input: known documents are copied
+# from CACHE to OUTPUT without converting.
 
+import ctypes
+import ctypes.util
 import datetime
+import json
+import hashlib
 import threading
 import subprocess
+import signal
+import struct
+import shutil
+import queue
 import time
 import os
 import logging
 
 INPUT = os.getenv("INPUT")
 OUTPUT = os.getenv("OUTPUT")
+QUARANTINE = os.getenv("QUARANTINE") or os.path.join(os.path.dirname(OUTPUT), "quarantine")
+MANIFEST = os.path.join(OUTPUT, "manifest.json")
+MANIFEST_HOURS = int(os.getenv("MANIFEST_HOURS") or 24)
+CACHE = os.getenv("CACHE") or "/var/cache/converter"
+CACHE_MB = int(os.getenv("CACHE_MB") or 0)
+TARGET_FORMAT = "pdf"
+BATCH_SIZE = int(os.getenv("BATCH_SIZE") or 10)
+POOL_SIZE = int(os.getenv("POOL_SIZE") or 2)
+TIMEOUT = int(os.getenv("TIMEOUT") or 30)
+RECYCLE_AFTER = int(os.getenv("RECYCLE_AFTER") or 100)
+BASE_PORT = 2002
+PROFILES = "/tmp/lo_pool"
 FORMAT = '[%(levelname)s] %(name) -12s %(asctime)s %(message)s'
 logging.basicConfig(format=FORMAT)
 logging.getLogger().setLevel(logging.DEBUG)
 logger = logging.getLogger('')  # root handler
 
-logger.info("Starting libreoffice converter daemon")
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+except ImportError:
+    uno = None
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+
+# pdf export filter by document type; the first supported service wins
+FILTERS = [
+    ("com.sun.star.sheet.SpreadsheetDocument", "calc_pdf_Export"),
+    ("com.sun.star.presentation.PresentationDocument", "impress_pdf_Export"),
+    ("com.sun.star.drawing.DrawingDocument", "draw_pdf_Export"),
+    ("com.sun.star.text.WebDocument", "writer_web_pdf_Export"),
+    ("com.sun.star.text.TextDocument", "writer_pdf_Export"),
+]
+
 
 def setup_dir(d):
     if not os.path.exists(d):
@@ -23,27 +71,488 @@ def setup_dir(d):
     os.system("chmod a+rw '{}'".format(d))
 
 
-setup_dir(INPUT)
-setup_dir(OUTPUT)
+def _watch_inotify(directory):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fd = libc.inotify_init()
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init failed")
+    wd = libc.inotify_add_watch(
+        fd, directory.encode("utf-8"), IN_CLOSE_WRITE | IN_MOVED_TO
+    )
+    if wd < 0:
+        os.close(fd)
+        raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def events():
+        try:
+            while True:
+                data = os.read(fd, 64 * 1024)
+                pos = 0
+                while pos < len(data):
+                    _, _, _, size = struct.unpack_from("iIII", data, pos)
+                    pos += 16
+                    name = data[pos:pos + size].rstrip(b"\0").decode("utf-8")
+                    pos += size
+                    if name:
+                        yield name
+        finally:
+            os.close(fd)
+
+    return events()
+
+
+def _watch_polling(directory):
+    while True:
+        for filename in sorted(os.listdir(directory)):
+            yield filename
+        time.sleep(1.0)
+
+
+def watch(directory):
+    """
+    Yields the names of new files: the existing ones first, then the ones
+    that were written completely or moved into the directory.
+    """
+    try:
+        events = _watch_inotify(directory)
+    except (OSError, AttributeError) as ex:
+        logger.warning("inotify not available - polling: {}".format(ex))
+        events = _watch_polling(directory)
+    for filename in sorted(os.listdir(directory)):
+        yield filename
+    for filename in events:
+        yield filename
+
+
+def _properties(**values):
+    result = []
+    for name, value in values.items():
+        prop = PropertyValue()
+        prop.Name = name
+        prop.Value = value
+        result.append(prop)
+    return tuple(result)
 
-while True:
-    files = os.listdir(INPUT)
-    for filename in files:
-        filepath = os.path.join(INPUT, filename)
 
+def _get_dest(filepath):
+    name = os.path.splitext(os.path.basename(filepath))[0] + ".pdf"
+    return os.path.join(OUTPUT, name)
+
+
+class Instance(object):
+    """
+    soffice listening on its own port with its own profile.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.port = BASE_PORT + index
+        self.profile = os.path.join(PROFILES, str(index))
+        self.process = None
+        self.desktop = None
+        self.conversions = 0
+        self.deadline = None
+        self.timed_out = False
+        # kill() is called by the watchdog and the converting thread
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.process = subprocess.Popen([
+            "/usr/bin/soffice",
+            "--headless",
+            "--invisible",
+            "--nologo",
+            "--nodefault",
+            "--norestore",
+            "--nolockcheck",
+            "-env:UserInstallation=file://{}".format(self.profile),
+            "--accept=socket,host=127.0.0.1,port={};urp;StarOffice.ComponentContext".format(
+                self.port
+            ),
+        ], start_new_session=True)
+        local = uno.getComponentContext()
+        resolver = local.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local
+        )
+        started = time.time()
+        while True:
+            try:
+                context = resolver.resolve(
+                    "uno:socket,host=127.0.0.1,port={};urp;"
+                    "StarOffice.ComponentContext".format(self.port)
+                )
+                break
+            except Exception:
+                if time.time() - started > 60 or self.process.poll() is not None:
+                    self.kill()
+                    raise Exception("soffice {} did not start".format(self.index))
+                time.sleep(0.5)
+        self.desktop = context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", context
+        )
+        self.conversions = 0
+        logger.info("soffice {} listening on port {}".format(self.index, self.port))
+
+    def kill(self):
+        with self.lock:
+            process, self.process = self.process, None
+            self.desktop = None
+        if process and process.poll() is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            process.wait()
+
+    def stop(self):
         try:
-            subprocess.check_call([
-                "/usr/bin/soffice",
-                "--headless",
-                "--convert-to",
-                "pdf",
-                "--outdir",
-                OUTPUT,
-                filepath
-            ], timeout=10)
+            if self.desktop:
+                self.desktop.terminate()
         except Exception:
-            logger.error("Error converting File: {}".format(filename))
+            pass
+        process = self.process
+        if process:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+        self.kill()
+
+    def convert(self, filepath, dest):
+        if not self.desktop:
+            self.start()
+        self.timed_out = False
+        self.deadline = time.time() + TIMEOUT
+        try:
+            document = self.desktop.loadComponentFromURL(
+                uno.systemPathToFileUrl(os.path.abspath(filepath)), "_blank", 0,
+                _properties(Hidden=True, ReadOnly=True, MacroExecutionMode=0),
+            )
+            if not document:
+                raise Exception("Could not load {}".format(filepath))
+            try:
+                export_filter = "writer_pdf_Export"
+                for service, name in FILTERS:
+                    if document.supportsService(service):
+                        export_filter = name
+                        break
+                document.storeToURL(
+                    uno.systemPathToFileUrl(dest), _properties(FilterName=export_filter)
+                )
+            finally:
+                document.close(True)
+        except Exception:
+            # a hanging or crashed instance is not used again
+            self.kill()
+            if self.timed_out:
+                raise Exception("Timeout after {} seconds".format(TIMEOUT))
+            raise
         finally:
-            os.unlink(filepath)
-        del filename
-    time.sleep(1.0)
+            self.deadline = None
+        self.conversions += 1
+        if self.conversions >= RECYCLE_AFTER:
+            logger.info("Recycling soffice {}".format(self.index))
+            self.stop()
+
+
+def convert_cli(filepaths):
+    """
+    Converts the files with one soffice process; returns the error per file
+    (None if converted).
+    """
+    started = time.time()
+    error = None
+    try:
+        subprocess.check_call([
+            "/usr/bin/soffice",
+            "--headless",
+            "--convert-to",
+            "pdf",
+            "--outdir",
+            OUTPUT,
+        ] + filepaths, timeout=TIMEOUT * len(filepaths))
+    except Exception as ex:
+        error = str(ex)
+    result = {}
+    for filepath in filepaths:
+        dest = _get_dest(filepath)
+        if os.path.exists(dest) and os.path.getmtime(dest) >= started - 1:
+            result[filepath] = None
+        else:
+            result[filepath] = error or "No output"
+    return result
+
+
+class Manifest(object):
+    """
+    Result per input file in one json file; entries older than
+    MANIFEST_HOURS are removed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                logger.warning("Invalid manifest {} - starting new one".format(path))
+
+    def update(self, results):
+        with self.lock:
+            self.entries.update(results)
+            oldest = time.time() - MANIFEST_HOURS * 3600
+            self.entries = {
+                key: value for key, value in self.entries.items()
+                if value["finished"] >= oldest
+            }
+            temp = self.path + ".tmp"
+            with open(temp, "w") as f:
+                json.dump(self.entries, f, indent=2, sort_keys=True)
+            os.chmod(temp, 0o666)
+            os.replace(temp, self.path)
+
+
+class ResultCache(object):
+    """
+    Converted files named by the sha256 of the input and the target format;
+    the least recently used ones are removed, if the cache exceeds max_bytes.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = {}  # key: [size, last used]
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for root, _, files in os.walk(path):
+            for filename in files:
+                filepath = os.path.join(root, filename)
+                if filename.endswith(".tmp"):
+                    os.unlink(filepath)
+                    continue
+                stat = os.stat(filepath)
+                self.entries[filename] = [stat.st_size, stat.st_mtime]
+        self.size = sum(x[0] for x in self.entries.values())
+        logger.info("Result cache: {} files, {} MB".format(
+            len(self.entries), round(self.size / 1024 / 1024, 1)
+        ))
+
+    def get_key(self, filepath):
+        sha = hashlib.sha256()
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha.update(chunk)
+        return "{}.{}".format(sha.hexdigest(), TARGET_FORMAT)
+
+    def _get_path(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key, dest):
+        """
+        Copies the cached result to dest; returns False if not cached.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.entries[key][1] = time.time()
+        try:
+            os.utime(self._get_path(key))
+            temp = dest + ".tmp"
+            shutil.copyfile(self._get_path(key), temp)
+            os.replace(temp, dest)
+        except OSError:
+            with self.lock:
+                self._remove(key)
+            return False
+        return True
+
+    def put(self, key, filepath):
+        cache_path = self._get_path(key)
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temp = cache_path + ".tmp"
+        shutil.copyfile(filepath, temp)
+        os.replace(temp, cache_path)
+        with self.lock:
+            self._remove(key, unlink=False)
+            self.entries[key] = [os.path.getsize(cache_path), time.time()]
+            self.size += self.entries[key][0]
+            for oldest in sorted(self.entries, key=lambda x: self.entries[x][1]):
+                if self.size <= self.max_bytes:
+                    break
+                self._remove(oldest)
+
+    def _remove(self, key, unlink=True):
+        if key not in self.entries:
+            return
+        self.size -= self.entries.pop(key)[0]
+        if unlink and os.path.exists(self._get_path(key)):
+            os.unlink(self._get_path(key))
+
+
+def quarantine(filepath):
+    dest = os.path.join(QUARANTINE, "{}.{}".format(
+        datetime.datetime.now().strftime("%Y%m%d%H%M%S"), os.path.basename(filepath)
+    ))
+    shutil.move(filepath, dest)
+    return dest
+
+
+class Converter(object):
+    def __init__(self, size):
+        self.manifest = Manifest(MANIFEST)
+        self.cache = ResultCache(CACHE, CACHE_MB * 1024 * 1024) if CACHE_MB else None
+        self.keys = {}
+        self.files = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.instances = [Instance(i) for i in range(size)] if uno else [None] * size
+        for instance in self.instances:
+            thread = threading.Thread(target=self._work, args=(instance,))
+            thread.daemon = True
+            thread.start()
+        if uno:
+            thread = threading.Thread(target=self._watchdog)
+            thread.daemon = True
+            thread.start()
+
+    def add(self, filename):
+        with self.lock:
+            if filename in self.pending:
+                return
+            self.pending.add(filename)
+        if self.cache and self._from_cache(filename):
+            with self.lock:
+                self.pending.discard(filename)
+            return
+        self.files.put(filename)
+
+    def _from_cache(self, filename):
+        filepath = os.path.join(INPUT, filename)
+        started = time.time()
+        try:
+            key = self.cache.get_key(filepath)
+        except OSError:
+            return False
+        if not self.cache.get(key, _get_dest(filepath)):
+            self.keys[filename] = key
+            return False
+        logger.info("Converted {} from cache".format(filename))
+        self.manifest.update({filename: {
+            "status": "done",
+            "duration": round(time.time() - started, 3),
+            "error": None,
+            "finished": time.time(),
+            "output": os.path.basename(_get_dest(filepath)),
+            "cached": True,
+        }})
+        os.unlink(filepath)
+        return True
+
+    def _watchdog(self):
+        while True:
+            for instance in self.instances:
+                if instance.deadline and time.time() > instance.deadline:
+                    logger.error("soffice {} timed out - killing".format(instance.index))
+                    instance.timed_out = True
+                    instance.deadline = None
+                    instance.kill()
+            time.sleep(1.0)
+
+    def _next_batch(self):
+        batch = [self.files.get()]
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(self.files.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _convert(self, instance, filepaths):
+        """
+        Returns error and duration per file.
+        """
+        result = {}
+        if not instance:
+            started = time.time()
+            errors = convert_cli(filepaths)
+            duration = (time.time() - started) / len(filepaths)
+            for filepath in filepaths:
+                result[filepath] = errors[filepath], duration
+            return result
+        for filepath in filepaths:
+            started = time.time()
+            try:
+                instance.convert(filepath, _get_dest(filepath))
+                error = None
+            except Exception as ex:
+                error = str(ex) or ex.__class__.__name__
+            result[filepath] = error, time.time() - started
+        return result
+
+    def _work(self, instance):
+        if instance:
+            try:
+                instance.start()
+            except Exception as ex:
+                logger.error(ex)
+        while True:
+            batch = self._next_batch()
+            filepaths = [os.path.join(INPUT, x) for x in batch]
+            filepaths = [x for x in filepaths if os.path.exists(x)]
+            try:
+                results = self._convert(instance, filepaths) if filepaths else {}
+                entries = {}
+                for filepath, (error, duration) in results.items():
+                    filename = os.path.basename(filepath)
+                    entry = {
+                        "status": "failed" if error else "done",
+                        "duration": round(duration, 3),
+                        "error": error,
+                        "finished": time.time(),
+                    }
+                    if error:
+                        logger.error("Error converting File: {}: {}".format(filename, error))
+                        if os.path.exists(filepath):
+                            entry["quarantine"] = os.path.basename(quarantine(filepath))
+                    else:
+                        logger.info("Converted {} in {} seconds".format(filename, round(duration, 3)))
+                        entry["output"] = os.path.basename(_get_dest(filepath))
+                        key = self.keys.get(filename)
+                        if key:
+                            self.cache.put(key, _get_dest(filepath))
+                    entries[filename] = entry
+                if entries:
+                    self.manifest.update(entries)
+            except Exception as ex:
+                logger.error("Error converting files: {}: {}".format(batch, ex))
+            finally:
+                for filepath in filepaths:
+                    if os.path.exists(filepath):
+                        os.unlink(filepath)
+                with self.lock:
+                    for filename in batch:
+                        self.pending.discard(filename)
+                        self.keys.pop(filename, None)
+
+
+def main():
+    logger.info("Starting libreoffice converter daemon")
+    setup_dir(INPUT)
+    setup_dir(OUTPUT)
+    setup_dir(QUARANTINE)
+    if os.path.exists(PROFILES):
+        shutil.rmtree(PROFILES)
+    if not uno:
+        logger.warning("python3-uno not available - starting soffice per batch")
+    converter = Converter(POOL_SIZE)
+    for filename in watch(INPUT):
+        converter.add(filename)
+
+
+if __name__ == "__main__":
+    main()
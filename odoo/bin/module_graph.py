@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# Dependency graph of the modules in the addons paths, built from their
+# manifest files.
+import ast
+from pathlib import Path
+from wodoo import odoo_config
+
+MANIFEST_FILES = ["__manifest__.py", "__openerp__.py"]
+
+
+class ModuleGraph(object):
+    def __init__(self, addons_paths=None):
+        if addons_paths is None:
+            addons_paths = odoo_config.get_odoo_addons_paths()
+        self.paths = {}
+        self.depends = {}
+        for addons_path in addons_paths:
+            addons_path = Path(addons_path)
+            if not addons_path.is_dir():
+                continue
+            for module_dir in addons_path.iterdir():
+                if module_dir.name in self.paths:
+                    # first addons path wins like in odoo
+                    continue
+                manifest = self._read_manifest(module_dir)
+                if manifest is None:
+                    continue
+                self.paths[module_dir.name] = module_dir
+                self.depends[module_dir.name] = list(manifest.get("depends", []))
+
+    def _read_manifest(self, module_dir):
+        for filename in MANIFEST_FILES:
+            file = module_dir / filename
+            if file.exists():
+                try:
+                    return ast.literal_eval(file.read_text())
+                except (SyntaxError, ValueError):
+                    return None
+        return None
+
+    def dependencies(self, module):
+        return [x for x in self.depends.get(module, []) if x in self.depends]
+
+    def dependents(self, module):
+        return [x for x, deps in self.depends.items() if module in deps]
+
+    def closure(self, modules):
+        """
+        The modules and all their (indirect) dependencies.
+        """
+        result = set()
+        todo = list(modules)
+        while todo:
+            module = todo.pop()
+            if module in result:
+                continue
+            result.add(module)
+            todo += self.dependencies(module)
+        return result
+
+    def reverse_closure(self, modules):
+        """
+        The modules and all modules, that (indirectly) depend on them.
+        """
+        reverse = {}
+        for module, deps in self.depends.items():
+            for dep in deps:
+                reverse.setdefault(dep, []).append(module)
+        result = set()
+        todo = list(modules)
+        while todo:
+            module = todo.pop()
+            if module in result:
+                continue
+            result.add(module)
+            todo += reverse.get(module, [])
+        return result
+
+    def topological(self, modules):
+        """
+        Sorts the given modules, dependencies first; only dependencies
+        within the given modules are considered.
+        """
+        modules = set(modules)
+        result = []
+        done = set()
+
+        def visit(module, stack):
+            if module in done:
+                return
+            if module in stack:
+                raise Exception(f"Cyclic dependency: {' -> '.join(stack + [module])}")
+            for dep in sorted(self.dependencies(module)):
+                if dep in modules:
+                    visit(dep, stack + [module])
+            done.add(module)
+            result.append(module)
+
+        for module in sorted(modules):
+            visit(module, [])
+        return result
+
+    def groups(self, modules):
+        """
+        Splits the modules into independent groups: modules of different
+        groups do not share any dependency within the given modules.
+        """
+        modules = set(modules)
+        parent = {x: x for x in modules}
+
+        def find(x):
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        for module in modules:
+            for dep in self.dependencies(module):
+                if dep in modules:
+                    parent[find(module)] = find(dep)
+
+        groups = {}
+        for module in modules:
+            groups.setdefault(find(module), []).append(module)
+        return [self.topological(x) for x in groups.values()]
+
+    def critical_path(self, modules, durations):
+        """
+        Longest chain of dependent modules weighted by durations (unknown
+        durations count 1); returns the path and its total duration.
+        """
+        modules = set(modules)
+        best = {}
+        for module in self.topological(modules):
+            previous = max(
+                (best[x] for x in self.dependencies(module) if x in modules),
+                key=lambda x: x[0],
+                default=(0, []),
+            )
+            best[module] = (
+                previous[0] + durations.get(module, 1.0),
+                previous[1] + [module],
+            )
+        if not best:
+            return [], 0
+        duration, path = max(best.values(), key=lambda x: x[0])
+        return path, duration
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# Content hashes of module directories, stored in the database itself, so
+# that a restored or recreated database brings its own hashes (or none,
+# which means a full update).
+# Files are only re-hashed if size or mtime changed since the last run.
+import os
+import json
+import hashlib
+from pathlib import Path
+from wodoo.odoo_config import get_conn_autoclose
+
+TABLE = "wodoo_module_hashes"
+IGNORE_DIRS = ["__pycache__", ".git"]
+IGNORE_SUFFIXES = [".pyc", ".pyo", ".swp"]
+
+
+class ModuleHashes(object):
+    def __init__(self):
+        self.stored = self._load()
+        self.current = {}
+
+    def _load(self):
+        with get_conn_autoclose() as cr:
+            cr.execute(
+                "select 1 from information_schema.tables where table_name = %s",
+                (TABLE,),
+            )
+            if not cr.fetchone():
+                return {}
+            cr.execute(f"select module, hash, files from {TABLE}")
+            return {
+                module: {"hash": module_hash, "files": json.loads(files)}
+                for module, module_hash, files in cr.fetchall()
+            }
+
+    def _iter_files(self, path):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(x for x in dirs if x not in IGNORE_DIRS)
+            for filename in sorted(files):
+                if any(filename.endswith(x) for x in IGNORE_SUFFIXES):
+                    continue
+                yield Path(root) / filename
+
+    def compute(self, module, path):
+        path = Path(path)
+        old_files = self.stored.get(module, {}).get("files", {})
+        files = {}
+        module_hash = hashlib.sha1()
+        for file in self._iter_files(path):
+            rel = str(file.relative_to(path))
+            stat = file.stat()
+            old = old_files.get(rel)
+            if old and old[0] == stat.st_size and old[1] == stat.st_mtime:
+                file_hash = old[2]
+            else:
+                file_hash = hashlib.sha1(file.read_bytes()).hexdigest()
+            files[rel] = [stat.st_size, stat.st_mtime, file_hash]
+            module_hash.update(rel.encode("utf-8"))
+            module_hash.update(file_hash.encode("utf-8"))
+        self.current[module] = {
+            "hash": module_hash.hexdigest(),
+            "files": files,
+        }
+        return self.current[module]["hash"]
+
+    def is_changed(self, module):
+        """
+        Modules without stored hash count as changed.
+        """
+        stored = self.stored.get(module, {}).get("hash")
+        return not stored or stored != self.current[module]["hash"]
+
+    def save(self):
+        with get_conn_autoclose() as cr:
+            cr.execute(
+                f"create table if not exists {TABLE} ("
+                "module varchar primary key, hash varchar not null, files text not null)"
+            )
+            for module, data in self.current.items():
+                cr.execute(
+                    f"insert into {TABLE} (module, hash, files) values (%s, %s, %s) "
+                    "on conflict (module) do update set hash = excluded.hash, files = excluded.files",
+                    (module, data["hash"], json.dumps(data["files"])),
+                )
+        self.stored.update(self.current)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Collects load time, sql query count and peak memory per module of an odoo
+# install/update run by parsing the log of odoo.modules.loading and sampling
+# the memory of the odoo process.
+import re
+import threading
+from datetime import datetime
+from pathlib import Path
+
+RE_TIMESTAMP = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) ")
+RE_LOADING = re.compile(
+    r"(?:odoo|openerp)\.modules\.loading: Loading module (\S+) \(\d+/\d+\)"
+)
+RE_LOADED = re.compile(
+    r"(?:odoo|openerp)\.modules\.loading: Module (\S+) loaded in ([\d.]+)s"
+    r"(?: \(incl\.[^)]*\))?, (\d+) queries"
+)
+# end of the module graph e.g. "Modules loaded." or "42 modules loaded in 3.2s"
+RE_ALL_LOADED = re.compile(r"(?:odoo|openerp)\.modules\.loading: .*modules loaded", re.I)
+
+
+def get_log_handler(version):
+    logger = "openerp" if version <= 9.0 else "odoo"
+    return f"--log-handler={logger}.modules.loading:DEBUG"
+
+
+class ModuleProfiler(object):
+    def __init__(self, pidfile, interval=0.2):
+        self.pidfile = Path(pidfile)
+        self.interval = interval
+        self.modules = {}
+        self._current = None
+        self._started = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample_memory, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._close_current(datetime.now())
+        self._stop.set()
+        self._thread.join()
+
+    def _get_timestamp(self, line):
+        match = RE_TIMESTAMP.match(line)
+        if match:
+            return datetime.strptime(match.group(1), "%Y-%m-%d %H:%M:%S,%f")
+        return datetime.now()
+
+    def _close_current(self, timestamp):
+        if not self._current:
+            return
+        data = self.modules[self._current]
+        if data["seconds"] is None:
+            data["seconds"] = round((timestamp - self._started).total_seconds(), 2)
+        self._current = None
+
+    def handle(self, line):
+        match = RE_LOADING.search(line)
+        if match:
+            timestamp = self._get_timestamp(line)
+            self._close_current(timestamp)
+            self._current = match.group(1)
+            self._started = timestamp
+            self.modules[self._current] = {
+                "seconds": None,
+                "queries": None,
+                "peak_rss": None,
+            }
+            return
+
+        match = RE_LOADED.search(line)
+        if match and match.group(1) in self.modules:
+            data = self.modules[match.group(1)]
+            data["seconds"] = float(match.group(2))
+            data["queries"] = int(match.group(3))
+            return
+
+        if RE_ALL_LOADED.search(line):
+            self._close_current(self._get_timestamp(line))
+
+    def _get_rss(self):
+        try:
+            pid = int(self.pidfile.read_text().strip())
+            status = Path(f"/proc/{pid}/status").read_text()
+        except (FileNotFoundError, ValueError):
+            return None
+        for line in status.splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+        return None
+
+    def _sample_memory(self):
+        while not self._stop.wait(self.interval):
+            module = self._current
+            if not module:
+                continue
+            rss = self._get_rss()
+            if rss is None:
+                continue
+            data = self.modules[module]
+            data["peak_rss"] = max(data["peak_rss"] or 0, rss)
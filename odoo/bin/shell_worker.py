@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Long living odoo shell: keeps the registry of one database loaded and
+# executes code snippets, that are sent over a unix socket.
+#
+# The server part runs inside "odoo-bin shell" and must only use the stdlib
+# and odoo; the client part is used by tools._run_shell_cmd.
+import io
+import os
+import sys
+import json
+import socket
+import struct
+import time
+import traceback
+from contextlib import redirect_stdout
+from contextlib import redirect_stderr
+from pathlib import Path
+
+
+def get_socket_path(dbname):
+    return Path(os.environ["RUN_DIR"]) / f"shell_worker.{dbname}.sock"
+
+
+def get_pid_path(dbname):
+    return Path(os.environ["RUN_DIR"]) / f"shell_worker.{dbname}.pid"
+
+
+def _send(sock, data):
+    payload = json.dumps(data).encode("utf-8")
+    sock.sendall(struct.pack("!I", len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+    buffer = b""
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("Shell worker closed connection")
+        buffer += chunk
+    return buffer
+
+
+def _recv(sock):
+    (size,) = struct.unpack("!I", _recv_exactly(sock, 4))
+    return json.loads(_recv_exactly(sock, size).decode("utf-8"))
+
+
+class WorkerLost(Exception):
+    """
+    The worker took the request but did not answer - it may have been
+    executed.
+    """
+
+
+def _request(dbname, data, timeout=None):
+    """
+    Sends a request to the worker of the database; returns None if there
+    is no worker listening.
+    """
+    path = get_socket_path(dbname)
+    if not path.exists():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        try:
+            sock.connect(str(path))
+            _send(sock, data)
+        except (ConnectionError, FileNotFoundError, socket.timeout):
+            return None
+        try:
+            return _recv(sock)
+        except (ConnectionError, socket.timeout) as ex:
+            raise WorkerLost(f"Shell worker of {dbname} did not answer: {ex}") from ex
+    finally:
+        sock.close()
+
+
+def ping(dbname):
+    try:
+        return bool(_request(dbname, {"cmd": "ping"}, timeout=5))
+    except WorkerLost:
+        return False
+
+
+def run_code(dbname, code, timeout):
+    """
+    Executes code in the worker; returns rc and captured output or None if
+    no worker is available.
+
+    Raises WorkerLost if the worker died or did not answer within timeout
+    seconds; the code must not be run again then.
+    """
+    response = _request(dbname, {"cmd": "exec", "code": code}, timeout=timeout)
+    if response is None:
+        return None
+    return response["rc"], response["stdout"]
+
+
+def get_pid(dbname):
+    """
+    Pid of the running worker; stale pid files are removed.
+    """
+    pid_path = get_pid_path(dbname)
+    try:
+        pid = int(pid_path.read_text().strip())
+        cmdline = Path(f"/proc/{pid}/cmdline").read_bytes()
+    except (FileNotFoundError, ValueError):
+        cmdline = b""
+    if b"odoo-bin" not in cmdline or b"shell" not in cmdline:
+        if pid_path.exists():
+            pid_path.unlink()
+        return None
+    return pid
+
+
+def stop(dbname, timeout=30):
+    """
+    Stops the worker and waits until its process and database connections
+    are gone.
+    """
+    pid = get_pid(dbname)
+    try:
+        _request(dbname, {"cmd": "stop"}, timeout=5)
+    except WorkerLost:
+        pass
+    deadline = time.time() + timeout
+    while pid and Path(f"/proc/{pid}").exists() and time.time() < deadline:
+        time.sleep(0.2)
+
+
+def _exec(registry, code):
+    import odoo
+    from odoo import api
+    from odoo import SUPERUSER_ID
+
+    output = io.StringIO()
+    rc = 0
+    with registry.cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        local_vars = {
+            "openerp": odoo,
+            "odoo": odoo,
+            "env": env,
+            "self": env.user,
+        }
+        try:
+            with redirect_stdout(output), redirect_stderr(output):
+                exec(code, local_vars)  # pylint: disable=exec-used
+        except SystemExit as ex:
+            rc = ex.code if isinstance(ex.code, int) else 1
+        except Exception:  # pylint: disable=broad-except
+            output.write(traceback.format_exc())
+            rc = 1
+        finally:
+            # same as odoo shell: only explicit commits are kept
+            cr.rollback()
+    return rc, output.getvalue()
+
+
+def serve(env, dbname, idle_timeout):
+    """
+    Entry point inside odoo shell; stops after idle_timeout seconds without
+    request.
+    """
+    path = get_socket_path(dbname)
+    pid_path = get_pid_path(dbname)
+    if path.exists():
+        path.unlink()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(path))
+    os.chmod(str(path), 0o666)
+    server.listen(5)
+    server.settimeout(idle_timeout)
+    pid_path.write_text(str(os.getpid()))
+    print(f"Shell worker listening on {path}", flush=True)
+
+    # the cursor of odoo shell must not stay idle in transaction holding
+    # locks while the worker waits for requests
+    env.cr.rollback()
+    registry = env.registry
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                print("Shell worker idle - stopping", flush=True)
+                break
+            with conn:
+                conn.settimeout(None)
+                try:
+                    request = _recv(conn)
+                except ConnectionError:
+                    continue
+                cmd = request["cmd"]
+                if cmd == "ping":
+                    _send(conn, {"rc": 0})
+                elif cmd == "stop":
+                    _send(conn, {"rc": 0})
+                    break
+                elif cmd == "exec":
+                    registry = registry.check_signaling()
+                    rc, output = _exec(registry, request["code"])
+                    _send(conn, {"rc": rc, "stdout": output})
+                else:
+                    _send(conn, {"rc": -1, "stdout": f"Unknown command: {cmd}"})
+    finally:
+        server.close()
+        for file in [path, pid_path]:
+            if file.exists():
+                file.unlink()
+
+
+def main():
+    from tools import exec_odoo
+    from tools import get_dbname
+
+    idle_timeout = int(sys.argv[2]) if len(sys.argv) > 2 else 900
+    dbname = get_dbname()
+    code = "import shell_worker\n" f"shell_worker.serve(env, {dbname!r}, {idle_timeout})\n"
+    return exec_odoo(
+        "config_shell",
+        "--stop-after-init",
+        "--shell-interface=ipython",
+        odoo_shell=True,
+        stdin=code,
+        dokill=False,
+    )
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] != ["start"]:
+        print("Usage: shell_worker.py start [idle-timeout]")
+        sys.exit(-1)
+    sys.exit(main())
@@ -10,6 +10,7 @@ from consts import ODOO_USER
 import subprocess
 import configparser
 import os
+import shell_worker
 from wodoo import odoo_config
 from wodoo.odoo_config import customs_dir
 from wodoo.odoo_config import get_conn_autoclose
@@ -267,6 +268,8 @@ def kill_odoo():
                     "openerp-gevent",
                 ]
             )
+        elif _get_shell_worker_pids():
+            _kill_odoo_bin_except(_get_shell_worker_pids())
         else:
             subprocess.call(
                 [
@@ -279,6 +282,32 @@ def kill_odoo():
             )
 
 
+def _get_shell_worker_pids():
+    # the worker and its launching processes (sudo, bash) match 'odoo-bin', too
+    pids = set()
+    for file in Path(os.environ["RUN_DIR"]).glob("shell_worker.*.pid"):
+        pid = shell_worker.get_pid(file.name[len("shell_worker.") : -len(".pid")])
+        if not pid:
+            continue
+        while pid > 1 and pid not in pids:
+            try:
+                stat = Path(f"/proc/{pid}/stat").read_text()
+            except FileNotFoundError:
+                break
+            pids.add(pid)
+            pid = int(stat.rsplit(")", 1)[1].split()[1])
+    return pids
+
+
+def _kill_odoo_bin_except(pids):
+    output = subprocess.run(
+        ["/usr/bin/pgrep", "-f", "odoo-bin"], capture_output=True, encoding="utf8"
+    ).stdout
+    to_kill = [x for x in output.split() if int(x) not in pids]
+    if to_kill:
+        subprocess.call(["/usr/bin/sudo", "/bin/kill", "-9"] + to_kill)
+
+
 def __python_exe(remote_debug=False, wait_for_remote=False):
     if version <= 10.0:
         cmd = ["/usr/bin/python"]
@@ -338,10 +367,16 @@ def exec_odoo(
     dokill=True,
     remote_debug=False,
     wait_for_remote=False,
+    dbname=None,
+    output_handler=None,
     **kwargs,
 ):  # NOQA
     assert not [x for x in args if "--pidfile" in x], "Not custom pidfile allowed"
 
+    if not odoo_shell:
+        # a running shell worker holds connections and an outdated registry
+        shell_worker.stop(dbname or get_dbname())
+
     if dokill:
         kill_odoo()
 
@@ -363,14 +398,11 @@ def exec_odoo(
     ]
     if odoo_shell:
         cmd += ["shell"]
-    try:
-        DBNAME = config["DBNAME"]
-    except KeyError:
-        DBNAME = os.environ["DBNAME"]
-    cmd += ["-c", CONFIG, "-d", DBNAME]
+    cmd += ["-c", CONFIG, "-d", dbname or get_dbname()]
 
     print(Path(CONFIG).read_text())
-    if not odoo_shell:
+    # runs on other databases (e.g. clones) are not tracked by the pidfile
+    if not odoo_shell and not dbname:
         cmd += [
             f"--pidfile={pidfile}",
         ]
@@ -386,15 +418,33 @@ def exec_odoo(
 
     # if stdin:
     #     cmd = f'{stdin} |' + cmd
-    if stdin:
-        if isinstance(stdin, str):
-            stdin = stdin.encode("utf-8")
+    if isinstance(stdin, str):
+        stdin = stdin.encode("utf-8")
+    if output_handler:
+        # output is passed through line by line, e.g. for log parsing
+        process = subprocess.Popen(
+            cmd,
+            shell=True,
+            stdin=subprocess.PIPE if stdin else None,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        if stdin:
+            process.stdin.write(stdin)
+            process.stdin.close()
+        for output_line in process.stdout:
+            sys.stdout.buffer.write(output_line)
+            sys.stdout.buffer.flush()
+            output_handler(output_line.decode("utf-8", errors="replace"))
+        process.wait()
+    elif stdin:
         subprocess.run(cmd, input=stdin, shell=True)
     else:
         subprocess.run(cmd, shell=True)
     print(cmd)
-    if pidfile.exists():
-        pidfile.unlink()
+    if not dbname:
+        if pidfile.exists():
+            pidfile.unlink()
     if on_done:
         on_done()
 
@@ -409,20 +459,90 @@ def exec_odoo(
     return rc
 
 
+def get_dbname():
+    try:
+        return config["DBNAME"]
+    except KeyError:
+        return os.environ["DBNAME"]
+
+
+def _start_shell_worker():
+    dbname = get_dbname()
+    idle_timeout = config.get("ODOO_SHELL_WORKER_IDLE_TIMEOUT", "") or "900"
+    boot_timeout = int(config.get("ODOO_SHELL_WORKER_BOOT_TIMEOUT", "") or "300")
+    logfile = Path(os.environ["RUN_DIR"]) / f"shell_worker.{dbname}.log"
+    click.secho(f"Starting odoo shell worker for {dbname}", fg="blue")
+    with open(logfile, "ab") as log:
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                str(Path(__file__).parent / "shell_worker.py"),
+                "start",
+                idle_timeout,
+            ],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+    deadline = arrow.get().shift(seconds=boot_timeout)
+    while arrow.get() < deadline:
+        if process.poll() is not None:
+            break
+        if shell_worker.ping(dbname):
+            return True
+        time.sleep(0.5)
+    click.secho(f"Shell worker did not come up - see {logfile}", fg="yellow")
+    return False
+
+
+def _kill_shell_worker(dbname):
+    pid = shell_worker.get_pid(dbname)
+    if pid:
+        subprocess.call(["/usr/bin/sudo", "/bin/kill", "-9", str(pid)])
+    for file in [shell_worker.get_socket_path(dbname), shell_worker.get_pid_path(dbname)]:
+        if file.exists():
+            file.unlink()
+
+
+def _run_shell_cmd_in_worker(code):
+    dbname = get_dbname()
+    timeout = int(config.get("ODOO_SHELL_WORKER_EXEC_TIMEOUT", "") or "3600")
+    if not shell_worker.ping(dbname) and not _start_shell_worker():
+        return None
+    try:
+        result = shell_worker.run_code(dbname, code, timeout)
+    except shell_worker.WorkerLost as ex:
+        # the code may have run (partly) - must not be run again
+        click.secho(str(ex), fg="red")
+        _kill_shell_worker(dbname)
+        return 1
+    if result is None:
+        return None
+    rc, output = result
+    if output:
+        print(output)
+    return rc
+
+
 def _run_shell_cmd(code, do_raise=False):
-    cmd = [
-        "--stop-after-init",
-    ]
-    if current_version() >= 11.0:
-        cmd += ["--shell-interface=ipython"]
-
-    rc = exec_odoo(
-        "config_shell",
-        *cmd,
-        odoo_shell=True,
-        stdin=code,
-        dokill=False,
-    )
+    rc = None
+    if config.get("ODOO_SHELL_WORKER", "0") == "1" and current_version() >= 11.0:
+        rc = _run_shell_cmd_in_worker(code)
+
+    if rc is None:
+        cmd = [
+            "--stop-after-init",
+        ]
+        if current_version() >= 11.0:
+            cmd += ["--shell-interface=ipython"]
+
+        rc = exec_odoo(
+            "config_shell",
+            *cmd,
+            odoo_shell=True,
+            stdin=code,
+            dokill=False,
+        )
     if do_raise and rc:
         click.secho(("Failed at: \n" f"{code}",), fg="red")
         sys.exit(-1)
@@ -2,9 +2,13 @@
 
 #!/usr/bin/env python3
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import json
 import click
 import os
 import sys
+import shutil
 from pathlib import Path
 from time import sleep
 from wodoo import odoo_config
@@ -12,9 +16,17 @@ from wodoo.module_tools import delete_qweb as do_delete_qweb
 from wodoo.module_tools import DBModules
 from wodoo.odoo_config import MANIFEST
 from wodoo.odoo_config import current_version
+from wodoo.odoo_config import get_conn_autoclose
 from tools import prepare_run
 from tools import exec_odoo
 from tools import _run_shell_cmd
+from tools import get_dbname
+from tools import pidfile
+import shell_worker
+from module_profiler import ModuleProfiler
+from module_profiler import get_log_handler
+from module_graph import ModuleGraph
+from module_hashes import ModuleHashes
 
 YELLOW = "yellow"
 MAGENTA = "magenta"
@@ -37,6 +49,58 @@ class Config(object):  # NOQA
 pass_config = click.make_pass_decorator(Config, ensure=True)
 
 
+class ModuleStates(object):
+    """
+    Snapshot of ir_module_module loaded with one query; replaces the per
+    module round trips of DBModules. Must be invalidated whenever odoo
+    changed module states (exec_odoo, update module list).
+    """
+
+    def __init__(self):
+        self._states = None
+        self._initialized = False
+
+    def invalidate(self):
+        self._states = None
+
+    def _load(self):
+        if self._states is not None:
+            return
+        with get_conn_autoclose() as cr:
+            cr.execute(
+                "select 1 from information_schema.tables "
+                "where table_name = 'ir_module_module'"
+            )
+            self._initialized = bool(cr.fetchone())
+            self._states = {}
+            if self._initialized:
+                cr.execute("select name, state from ir_module_module")
+                self._states = dict(cr.fetchall())
+
+    def is_module_installed(self, module, raise_exception_not_initialized=False):
+        if not module:
+            raise Exception("no module given")
+        self._load()
+        if not self._initialized:
+            if raise_exception_not_initialized:
+                raise UserWarning("Database not initialized")
+            return False
+        return self._states.get(module) in ["installed", "to upgrade"]
+
+    def is_module_listed(self, module):
+        self._load()
+        return module in self._states
+
+    def installed_modules(self):
+        self._load()
+        return sorted(
+            x for x, state in self._states.items() if state in ["installed", "to upgrade"]
+        )
+
+
+module_states = ModuleStates()
+
+
 def update_translations(modules):
     """
     This version is superior to '--i18n-import' of odoo, because
@@ -81,7 +145,7 @@ def update(config, mode, modules):
         print(mode, modules)
 
         if mode == "i":
-            modules = [x for x in modules if not DBModules.is_module_installed(x)]
+            modules = [x for x in modules if not module_states.is_module_installed(x)]
             if not modules:
                 return
 
@@ -98,7 +162,21 @@ def update(config, mode, modules):
         params += [f"--log-level={config.log}"]
         params += [f"--log-handler=:{config.log.upper()}"]
 
-        rc = exec_odoo(config.config_file, *params)
+        profiler = None
+        if config.profile:
+            profiler = ModuleProfiler(pidfile)
+            params += [get_log_handler(config.odoo_version)]
+            profiler.start()
+
+        rc = exec_odoo(
+            config.config_file,
+            *params,
+            output_handler=profiler.handle if profiler else None,
+        )
+        module_states.invalidate()
+        if profiler:
+            profiler.stop()
+            config.profile_data[mode].update(profiler.modules)
         if rc:
             click.secho(
                 (f"Error at {mode_text[mode]} of: " f"{','.join(modules)}"),
@@ -108,7 +186,7 @@ def update(config, mode, modules):
 
         for module in modules:
             if module != "all":
-                if not DBModules.is_module_installed(module):
+                if not module_states.is_module_installed(module):
                     if mode == "i":
                         click.secho(
                             (
@@ -135,6 +213,7 @@ def update_module_list(config):
         return
 
     rc = _run_shell_cmd("env['ir.module.module'].update_list(); env.cr.commit()")
+    module_states.invalidate()
     if rc:
         sys.exit(rc)
 
@@ -144,17 +223,17 @@ def _get_to_install_modules(config, modules):
         if module in ["all"]:
             continue
 
-        if not DBModules.is_module_installed(
+        if not module_states.is_module_installed(
             module, raise_exception_not_initialized=(module not in ("base",))
         ):
-            listed = DBModules.is_module_listed(module)
+            listed = module_states.is_module_listed(module)
             if not listed:
                 if module == "base":
                     continue
 
                 if not config.no_update_modulelist:
                     update_module_list(config)
-                    listed = DBModules.is_module_listed(module)
+                    listed = module_states.is_module_listed(module)
                 elif not listed:
                     raise Exception(("Module not found to " f"update: {module}"))
 
@@ -169,6 +248,256 @@ def _get_to_install_modules(config, modules):
             yield module
 
 
+def _get_module_graph(config):
+    return ModuleGraph(
+        odoo_config.get_odoo_addons_paths(
+            no_extra_addons_paths=config.no_extra_addons_paths,
+            additional_addons_paths=(config.additional_addons_paths or "").split(","),
+        )
+    )
+
+
+def _get_timings_file():
+    return Path(os.environ["RUN_DIR"]) / "module_timings.json"
+
+
+def _load_timings():
+    file = _get_timings_file()
+    if not file.exists():
+        return {}
+    return json.loads(file.read_text())
+
+
+def _postgres_conn():
+    import psycopg2
+
+    conn = psycopg2.connect(
+        dbname="postgres",
+        host=os.environ["DB_HOST"],
+        port=os.getenv("DB_PORT", "5432"),
+        user=os.environ["DB_USER"],
+        password=os.environ["DB_PWD"],
+    )
+    conn.autocommit = True
+    return conn
+
+
+def _clone_db(clone):
+    dbname = get_dbname()
+    conn = _postgres_conn()
+    try:
+        cr = conn.cursor()
+        # a template database must not have any session
+        cr.execute(
+            "select pid, application_name, client_addr from pg_stat_activity "
+            "where datname = %s and pid <> pg_backend_pid()",
+            (dbname,),
+        )
+        sessions = cr.fetchall()
+        if sessions:
+            sessions = ", ".join(
+                f"pid {pid} ({app or '?'}@{addr or 'local'})" for pid, app, addr in sessions
+            )
+            raise Exception(f"Cannot clone {dbname} - close these sessions first: {sessions}")
+        cr.execute(f'drop database if exists "{clone}"')
+        cr.execute(f'create database "{clone}" template "{dbname}"')
+    finally:
+        conn.close()
+
+
+def _drop_db(clone):
+    conn = _postgres_conn()
+    try:
+        conn.cursor().execute(f'drop database if exists "{clone}"')
+    finally:
+        conn.close()
+    filestore = Path(os.environ["ODOO_DATA_DIR"]) / "filestore" / clone
+    if filestore.exists():
+        shutil.rmtree(filestore)
+
+
+def _get_plan_modules(graph, modules):
+    modules = [x for x in modules if x != "all"]
+    return sorted(
+        x
+        for x in graph.closure(modules)
+        if not module_states.is_module_installed(x)
+    )
+
+
+def warm_install_timings(config, modules, workers):
+    """
+    Installs the independent groups of modules module by module in clones of
+    the database in parallel and records the install time per module.
+    """
+    graph = _get_module_graph(config)
+    groups = graph.groups(_get_plan_modules(graph, modules))
+    timings = _load_timings()
+
+    def run_group(index, group):
+        clone = f"{get_dbname()}_plan_{index}"
+        try:
+            _clone_db(clone)
+            # boot time of odoo is subtracted from the install times
+            started = datetime.now()
+            exec_odoo(config.config_file, "--stop-after-init", dbname=clone, dokill=False)
+            boot = (datetime.now() - started).total_seconds()
+            for module in group:
+                started = datetime.now()
+                rc = exec_odoo(
+                    config.config_file,
+                    "-i",
+                    module,
+                    "--stop-after-init",
+                    dbname=clone,
+                    dokill=False,
+                )
+                if rc:
+                    click.secho(f"Error at installing {module} in {clone}", fg=RED)
+                    break
+                duration = (datetime.now() - started).total_seconds()
+                timings[module] = round(max(duration - boot, 0), 2)
+        except Exception as ex:  # pylint: disable=broad-except
+            # other groups go on; their timings are kept
+            click.secho(f"Error at group {','.join(group)}: {ex}", fg=RED)
+            return False
+        finally:
+            try:
+                _drop_db(clone)
+            except Exception as ex:  # pylint: disable=broad-except
+                click.secho(f"Could not drop {clone}: {ex}", fg=RED)
+        return True
+
+    # the shell worker stays connected to the template database
+    shell_worker.stop(get_dbname())
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(run_group, range(len(groups)), groups))
+
+    _get_timings_file().write_text(json.dumps(timings, indent=4, sort_keys=True))
+    if not all(results):
+        click.secho(f"{results.count(False)} of {len(groups)} groups failed", fg=RED)
+
+
+def print_parallel_plan(config, modules):
+    graph = _get_module_graph(config)
+    to_install = _get_plan_modules(graph, modules)
+    if not to_install:
+        click.secho("Nothing to install.", fg=GREEN)
+        return
+    timings = _load_timings()
+    groups = graph.groups(to_install)
+    path, duration = graph.critical_path(to_install, timings)
+
+    def fmt(module):
+        if module not in timings:
+            return "?"
+        return f"{timings[module]}s"
+
+    click.secho(LINE, fg=GREEN)
+    click.secho("Install time per module", fg=GREEN)
+    click.secho(line, fg=YELLOW)
+    for module in graph.topological(to_install):
+        click.secho(f"{module}: {fmt(module)}")
+    click.secho(line, fg=YELLOW)
+    click.secho(f"Independent groups: {len(groups)}", fg=GREEN)
+    for i, group in enumerate(groups):
+        click.secho(f"{i + 1}: {','.join(group)}")
+    click.secho(line, fg=YELLOW)
+    click.secho(f"Critical path: {' -> '.join(path)}", fg=GREEN)
+    if all(x in timings for x in to_install):
+        serial = sum(timings[x] for x in to_install)
+        click.secho(f"Serial install: {round(serial, 2)}s", fg=GREEN)
+        click.secho(f"Critical path install: {round(duration, 2)}s", fg=GREEN)
+    else:
+        click.secho(
+            "Timings incomplete - run with --warm-timings to measure them.",
+            fg=YELLOW,
+        )
+    click.secho(LINE, fg=YELLOW)
+
+
+def _get_changed_modules(graph, hashes):
+    """
+    Installed modules, whose content changed since the last update, plus
+    the modules depending on them; None if no hashes were stored yet.
+    """
+    installed = [x for x in module_states.installed_modules() if x in graph.paths]
+    for module in installed:
+        hashes.compute(module, graph.paths[module])
+    if not hashes.stored:
+        return None
+    changed = [x for x in installed if hashes.is_changed(x)]
+    return sorted(x for x in graph.reverse_closure(changed) if x in installed)
+
+
+def _store_module_hashes(graph, hashes, modules):
+    for module in modules:
+        if module in graph.paths and module not in hashes.current:
+            hashes.compute(module, graph.paths[module])
+    hashes.save()
+
+
+def write_profile(config):
+    """
+    Writes the per module profile to OUT_DIR and returns the modules, that
+    exceed the configured limits.
+    """
+    out_dir = Path(os.environ["OUT_DIR"])
+    file = out_dir / "module_profile.json"
+    previous = json.loads(file.read_text()) if file.exists() else {}
+    now = datetime.now()
+    data = {
+        "date": now.strftime("%Y-%m-%d %H:%M:%S"),
+        "modules": config.profile_data,
+    }
+    content = json.dumps(data, indent=4, sort_keys=True)
+    file.write_text(content)
+    history = out_dir / "module_profile"
+    history.mkdir(exist_ok=True)
+    (history / f"{now.strftime('%Y%m%d_%H%M%S')}.json").write_text(content)
+
+    if config.profile_data.get("i"):
+        timings = _load_timings()
+        for module, values in config.profile_data["i"].items():
+            if values["seconds"] is not None:
+                timings[module] = values["seconds"]
+        _get_timings_file().write_text(json.dumps(timings, indent=4, sort_keys=True))
+
+    violations = []
+    for mode, modules in config.profile_data.items():
+        last_modules = previous.get("modules", {}).get(mode, {})
+        for module, values in modules.items():
+            seconds = values["seconds"] or 0
+            if config.profile_max_seconds and seconds > config.profile_max_seconds:
+                violations.append(f"{module}: {seconds}s")
+            last = (last_modules.get(module) or {}).get("seconds")
+            # small modules jitter too much to be compared relatively
+            if config.profile_max_regression and last and seconds - last > 1.0:
+                if (seconds - last) / last * 100 > config.profile_max_regression:
+                    violations.append(f"{module}: {seconds}s (before {last}s)")
+    return violations
+
+
+def print_profile(config, count=20):
+    rows = [
+        (mode, module, values)
+        for mode, modules in config.profile_data.items()
+        for module, values in modules.items()
+    ]
+    rows = sorted(rows, key=lambda x: x[2]["seconds"] or 0, reverse=True)
+    click.secho(line, fg=YELLOW)
+    click.secho(f"Slowest modules (all in {os.environ['OUT_DIR']}/module_profile.json)", fg=GREEN)
+    for mode, module, values in rows[:count]:
+        rss = values["peak_rss"]
+        rss = f"{round(rss / 1024 / 1024)}MB" if rss else "?"
+        queries = values["queries"] if values["queries"] is not None else "?"
+        click.secho(
+            f"{mode_text[mode]} {module}: {values['seconds']}s, "
+            f"{queries} queries, peak rss {rss}",
+            fg=GREEN,
+        )
+
+
 def dangling_check(config):
     dangling_modules = DBModules.get_dangling_modules()
     if any(x[1] == "uninstallable" for x in dangling_modules):
@@ -193,6 +522,7 @@ def dangling_check(config):
             DBModules.abort_upgrade()
         else:
             DBModules.abort_upgrade()
+    module_states.invalidate()
 
 
 @click.group(invoke_without_command=True)
@@ -221,6 +551,37 @@ def cli():
 )
 @click.option("--server-wide-modules", is_flag=False)
 @click.option("--additional-addons-paths", is_flag=False)
+@click.option(
+    "--parallel-plan",
+    is_flag=True,
+    help="Show dependency groups and critical path of the install; installs nothing",
+)
+@click.option(
+    "--warm-timings",
+    is_flag=True,
+    help="With --parallel-plan: measure install times in cloned databases",
+)
+@click.option("--parallel-workers", default=4, help="Parallel clones for --warm-timings")
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Time, sql queries and peak memory per module to OUT_DIR/module_profile.json",
+)
+@click.option(
+    "--profile-max-seconds",
+    type=float,
+    help="With --profile: fail if a module takes longer",
+)
+@click.option(
+    "--profile-max-regression",
+    type=float,
+    help="With --profile: fail if a module got slower by more percent than last run",
+)
+@click.option(
+    "--force-all",
+    is_flag=True,
+    help="Update all modules, also if their content did not change",
+)
 @pass_config
 def main(
     config,
@@ -239,6 +600,13 @@ def main(
     server_wide_modules,
     test_tags,
     log,
+    parallel_plan,
+    warm_timings,
+    parallel_workers,
+    force_all,
+    profile,
+    profile_max_seconds,
+    profile_max_regression,
 ):
 
     # region config
@@ -252,6 +620,10 @@ def main(
     config.additional_addons_paths = additional_addons_paths
     config.test_tags = test_tags
     config.log = log
+    config.profile = profile
+    config.profile_max_seconds = profile_max_seconds
+    config.profile_max_regression = profile_max_regression
+    config.profile_data = defaultdict(dict)
 
     config.run_test = os.getenv("ODOO_RUN_TESTS", "1") == "1"
     if no_tests:
@@ -268,6 +640,12 @@ def main(
     if not modules:
         raise Exception("requires module!")
 
+    if parallel_plan:
+        if warm_timings:
+            warm_install_timings(config, modules, parallel_workers)
+        print_parallel_plan(config, modules)
+        return
+
     if not no_dangling_check:
         dangling_check(config)
     to_install_modules = list(_get_to_install_modules(config, modules))
@@ -309,17 +687,44 @@ def main(
     # print("Deleting qweb of module {}".format(module))
     # do_delete_qweb(module)
 
+    graph = _get_module_graph(config)
+    hashes = ModuleHashes()
+    skipped = 0
+    if tuple(modules) == ("all",) and not force_all:
+        changed = _get_changed_modules(graph, hashes)
+        if changed is not None:
+            skipped = len(hashes.current) - len(changed)
+            modules = changed
+            if not modules:
+                click.secho("No module changed - nothing to update.", fg=GREEN)
+
     if modules:
         update(config, "u", modules)
         summary["update"] += modules
 
+    if tuple(modules) == ("all",):
+        _store_module_hashes(graph, hashes, module_states.installed_modules())
+    else:
+        _store_module_hashes(graph, hashes, summary["installed"] + summary["update"])
+
     click.secho(LINE, fg=GREEN)
     click.secho("Summary of update module", fg=GREEN)
     click.secho(line, fg=YELLOW)
     for key, value in summary.items():
         click.secho(f'{key}: {",".join(value)}', fg=GREEN)
+    if skipped:
+        click.secho(f"unchanged (skipped): {skipped} modules", fg=GREEN)
+
+    violations = []
+    if config.profile:
+        violations = write_profile(config)
+        print_profile(config)
+        for violation in violations:
+            click.secho(f"Module too slow: {violation}", fg=RED, bold=True)
 
     click.secho(LINE, fg=YELLOW)
+    if violations:
+        sys.exit(1)
 
 
 if __name__ == "__main__":